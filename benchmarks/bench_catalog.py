@@ -0,0 +1,57 @@
+"""
+Compare the time taken to gather sensor and result names using the lightweight catalog scan
+(`getShedCatalog`) with that of walking a complete shed index (the previous behaviour of `getSensorsAndResults`).
+
+Run from the repository root using: `python benchmarks/bench_catalog.py [holes] [boxes]`
+"""
+
+import os
+import sys
+import time
+import tempfile
+from synthetic import makeShed
+from hycore import loadShed
+from hywiz._flask import getShedIndexComplete, getShedCatalog
+
+def fromIndex( shed ):
+    """
+    Gather sensors and results by building and walking a complete shed index.
+    """
+    index = getShedIndexComplete( shed, cache=False )
+    sensors = set()
+    results = {}
+    for h in index['holes']:
+        for b in index[h]['boxes']:
+            sensors.update( index[h][b]['sensors'].keys() )
+            for r, l in index[h][b]['results'].items():
+                if results.get(r, '') == '':
+                    results[r] = l['leg']
+    return list(sensors), results
+
+def timeit( func, *args, repeats=3 ):
+    """
+    Return the best time (in seconds) of several calls to func(*args), and the last result.
+    """
+    best = None
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        out = func( *args )
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best, out
+
+if __name__ == '__main__':
+    holes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    boxes = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+    with tempfile.TemporaryDirectory() as root:
+        makeShed( root, holes=holes, boxes=boxes, bands=10 )
+        S = loadShed( os.path.join( root, 'synthetic.shed' ) )
+
+        t_index, (s0, r0) = timeit( fromIndex, S )
+        t_catalog, (s1, r1) = timeit( getShedCatalog, S )
+        assert set(s0) == set(s1) and r0 == r1, "Error - catalog does not match index."
+
+        print("Synthetic shed with %d holes and %d boxes:" % (holes, holes * boxes))
+        print("\t full index : %.3f s" % t_index)
+        print("\t catalog    : %.3f s" % t_catalog)
+        print("\t speedup    : %.1fx" % (t_index / t_catalog))
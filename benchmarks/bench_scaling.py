@@ -0,0 +1,189 @@
+"""
+Measure how the main hywiz operations (building the shed index, exporting static sites and serving data) scale with
+the size of a shed, using synthetic sheds (see `synthetic.py`) of configurable size. Results are written as json, such
+that runs (e.g., of different releases) can be compared to catch performance regressions.
+
+Run from the repository root using, e.g.:
+
+    `python benchmarks/bench_scaling.py --holes 1 2 4 --boxes 5 10 --out results.json`
+
+and compare two runs using:
+
+    `python benchmarks/bench_scaling.py --compare old.json new.json`
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import itertools
+import subprocess
+import tempfile
+from synthetic import makeShed
+from hycore import loadShed
+
+SENSORS = ('FENIX', 'LWIR', 'SWIR', 'MWIR', 'VNIR', 'RGB')
+"""
+Names used for the (synthetic) sensors in each box.
+"""
+
+def measure( func, repeats=3, setup=None ):
+    """
+    Time several calls to func().
+
+    :param func: The function to time (taking no arguments).
+    :param repeats: The number of times to call func.
+    :param setup: A function called (untimed) before each call to func, or None.
+    :return: A dictionary containing the `best` and `mean` times (in seconds) and a list of all `times`.
+    """
+    times = []
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        times.append( time.perf_counter() - t0 )
+    return dict( best=min(times), mean=sum(times) / len(times), times=times )
+
+def benchShed( root, holes, boxes, sensors, bands, dims, repeats=3 ):
+    """
+    Create a synthetic shed and time the main hywiz operations on it.
+
+    :param root: A (temporary) directory to create the shed and exported sites in.
+    :param holes: The number of holes.
+    :param boxes: The number of boxes in each hole.
+    :param sensors: The number of sensors in each box.
+    :param bands: The number of bands of each sensor.
+    :param dims: The (x, y) dimensions of each box.
+    :param repeats: The number of times to repeat each operation.
+    :return: A dictionary containing `timings` (see `measure(...)`) and `sizes` (in bytes) of the outputs.
+    """
+    from hywiz._flask import init, getShedIndexComplete, getShedIndexJS
+    from hywiz._static import copyImages, buildWeb
+    t0 = time.perf_counter()
+    makeShed( root, holes=holes, boxes=boxes, sensors=SENSORS[:sensors], bands=bands, dims=dims, mosaics=True )
+    S = loadShed( os.path.join( root, 'synthetic.shed' ) )
+    out = dict( setup=time.perf_counter() - t0, timings={}, sizes={} )
+    T = out['timings']
+
+    # shed index
+    T['getShedIndexComplete'] = measure( lambda: getShedIndexComplete( S, cache=False ), repeats )
+    T['getShedIndexComplete_cached'] = measure( lambda: getShedIndexComplete( S, cache=True ), repeats )
+    T['getShedIndexJS'] = measure( lambda: getShedIndexJS( S, compress=True, cache=False ), repeats )
+    out['sizes']['index.js'] = len( getShedIndexJS( S, compress=True ) )
+
+    # static exports
+    img = os.path.join( root, 'export', 'img' )
+    T['copyImages'] = measure( lambda: copyImages( S, img ), repeats,
+                               setup=lambda: shutil.rmtree( os.path.dirname( img ), ignore_errors=True ) )
+    T['copyImages_incremental'] = measure( lambda: copyImages( S, img, incremental=True ), repeats )
+    bean = os.path.join( root, 'synthetic.bean.exe.command' )
+    def clean():
+        if os.path.exists( bean ):
+            os.chmod( bean, 0o755 )
+            os.remove( bean )
+    T['buildWeb'] = measure( lambda: buildWeb( S, compile=True, incremental=False, vb=False ), repeats, setup=clean )
+    out['sizes']['bean'] = os.path.getsize( bean )
+
+    # server endpoints
+    client = init( S, render_bytes=0 ).test_client() # n.b. disable the render cache so each request renders
+    q = dict( hole='H01', box='001', sensor=SENSORS[0], vmin=2, vmax=98,
+              operation='b0|b%d|b%d' % (bands // 2, bands - 1) )
+    def get( path, **kwds ):
+        r = client.get( path, **kwds )
+        assert r.status_code == 200, "Error - %s returned %d" % (path, r.status_code)
+        r.get_data()
+        r.close()
+    T['whs_render'] = measure( lambda: get( '/whs', query_string=q ), repeats )
+    T['whs_probe'] = measure( lambda: get( '/whs', query_string=dict( q, operation='probe', x=5, y=5 ) ), repeats )
+    T['img_tray'] = measure( lambda: get( '/img/H01/001/%s.png' % SENSORS[0] ), repeats )
+    T['img_result'] = measure( lambda: get( '/img/H01/001/results/BR_Clays.png' ), repeats )
+    T['img_pole'] = measure( lambda: get( '/img/H01/pole/%s.png' % SENSORS[0] ), repeats )
+    T['img_fence'] = measure( lambda: get( '/img/H01/fence/%s.png' % SENSORS[0] ), repeats )
+    T['map_index'] = measure( lambda: get( '/map/index.json' ), repeats )
+    S.free()
+    return out
+
+def getEnvironment():
+    """
+    Describe the environment that benchmarks are run in, such that results can be compared meaningfully.
+    """
+    out = dict( python=platform.python_version(), platform=platform.platform(), cpus=os.cpu_count(),
+                time=time.strftime( '%Y-%m-%dT%H:%M:%S' ) )
+    try:
+        from importlib.metadata import version
+        out['hywiz'] = version( 'hywiz' )
+    except Exception:
+        out['hywiz'] = None # not installed
+    try:
+        out['commit'] = subprocess.check_output( ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                                 cwd=os.path.dirname( os.path.abspath( __file__ ) ) ).decode().strip()
+    except Exception:
+        out['commit'] = None
+    return out
+
+def compare( old, new, threshold=1.25 ):
+    """
+    Compare two benchmark results files and report operations that became slower.
+
+    :param old: Path to the reference results.
+    :param new: Path to the new results.
+    :param threshold: Ratio of new to old (best) times above which an operation is reported as a regression.
+    :return: A list of (config, operation, ratio) tuples for all regressions.
+    """
+    with open( old, 'r' ) as f:
+        old = json.load( f )
+    with open( new, 'r' ) as f:
+        new = json.load( f )
+    ref = { json.dumps( r['config'], sort_keys=True ) : r for r in old['results'] }
+    out = []
+    for r in new['results']:
+        k = json.dumps( r['config'], sort_keys=True )
+        if k not in ref:
+            continue # configuration was not benchmarked previously
+        print( k )
+        for op, t in r['timings'].items():
+            if op in ref[k]['timings']:
+                ratio = t['best'] / max( ref[k]['timings'][op]['best'], 1e-9 )
+                flag = ' <- regression' if ratio > threshold else ''
+                print( "\t %-28s %8.4f s -> %8.4f s (%.2fx)%s" % ( op, ref[k]['timings'][op]['best'], t['best'],
+                                                                   ratio, flag ) )
+                if ratio > threshold:
+                    out.append( ( k, op, ratio ) )
+    return out
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser( description='Benchmark how hywiz scales with shed size.' )
+    parser.add_argument( '--holes', type=int, nargs='+', default=[1, 2], help='Numbers of holes.' )
+    parser.add_argument( '--boxes', type=int, nargs='+', default=[5], help='Numbers of boxes per hole.' )
+    parser.add_argument( '--sensors', type=int, nargs='+', default=[2], help='Numbers of sensors per box.' )
+    parser.add_argument( '--bands', type=int, nargs='+', default=[20], help='Numbers of bands per sensor.' )
+    parser.add_argument( '--dims', type=str, nargs='+', default=['200x80'], help='Box dimensions (e.g., 200x80).' )
+    parser.add_argument( '--repeats', type=int, default=3, help='Number of times to repeat each operation.' )
+    parser.add_argument( '--out', type=str, default='bench_scaling.json', help='The json file to write results to.' )
+    parser.add_argument( '--compare', type=str, nargs=2, default=None, metavar=('OLD', 'NEW'),
+                         help='Compare two results files instead of running benchmarks.' )
+    parser.add_argument( '--threshold', type=float, default=1.25, help='Slowdown ratio reported as a regression.' )
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        sys.exit( 1 if len( compare( *args.compare, threshold=args.threshold ) ) > 0 else 0 )
+
+    results = []
+    for holes, boxes, sensors, bands, dims in itertools.product( args.holes, args.boxes, args.sensors,
+                                                                 args.bands, args.dims ):
+        assert sensors <= len(SENSORS), "Error - at most %d sensors are supported." % len(SENSORS)
+        config = dict( holes=holes, boxes=boxes, sensors=sensors, bands=bands, dims=dims )
+        print( "Benchmarking %s" % json.dumps( config ) )
+        with tempfile.TemporaryDirectory() as root:
+            r = benchShed( root, holes, boxes, sensors, bands, [int(d) for d in dims.split('x')], args.repeats )
+        results.append( dict( config=config, **r ) )
+        for op, t in r['timings'].items():
+            print( "\t %-28s %8.4f s" % ( op, t['best'] ) )
+
+    with open( args.out, 'w' ) as f:
+        json.dump( dict( version=1, environment=getEnvironment(), results=results ), f, indent=1 )
+    print( "Wrote results to %s" % args.out )
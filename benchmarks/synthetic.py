@@ -0,0 +1,77 @@
+"""
+Generate synthetic sheds of configurable size for benchmarking hywiz.
+"""
+
+import os
+import shutil
+import numpy as np
+import hylite
+from hylite import io
+from PIL import Image
+from hycore import Shed
+
+def makeShed( root, name='synthetic', holes : int = 2, boxes : int = 10, sensors : tuple = ('FENIX', 'LWIR'),
+              bands : int = 50, dims : tuple = (200, 80), results : tuple = ('BR_Clays',), mosaics : bool = False,
+              seed : int = 42 ):
+    """
+    Create a synthetic shed filled with random data.
+
+    :param root: The directory to create the shed in. Any existing shed with the same name will be deleted.
+    :param name: The name of the shed. Default is 'synthetic'.
+    :param holes: The number of holes to create.
+    :param boxes: The number of boxes in each hole.
+    :param sensors: The names of the sensors to create hyperspectral images (and .png previews) for.
+    :param bands: The number of bands in each hyperspectral image.
+    :param dims: The (x, y) dimensions of each box image.
+    :param results: The names of result images (with matching legends) to add to each box.
+    :param mosaics: True if (random) pole and fence mosaics should be added to each hole.
+    :param seed: Seed for the random number generator.
+    :return: A Shed instance.
+    """
+    for p in [os.path.join(root, name + '.shed'), os.path.join(root, name + '.hdr')]:
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        elif os.path.exists(p):
+            os.remove(p)
+    rng = np.random.default_rng(seed)
+    S = Shed(name, root)
+    for i in range(holes):
+        hname = 'H%02d' % (i + 1)
+        for j in range(boxes):
+            for k, s in enumerate(sensors):
+                img = hylite.HyImage(rng.random((dims[0], dims[1], bands)).astype(np.float32))
+                img.set_wavelengths(np.linspace(1000 * (k + 1), 1000 * (k + 2), bands))
+                b = S.addHSI(s, hname, '%03d' % (j + 1), img)
+                b.start = j * 5
+                b.end = (j + 1) * 5
+                b.save()
+                _png(rng, dims, os.path.join(b.getDirectory(), s + '.png'))
+                b.free()
+            for r in results:
+                _png(rng, dims, os.path.join(b.results.getDirectory(), r + '.png'))
+                _png(rng, (100, 20), os.path.join(b.results.getDirectory(),
+                                                  'LEG_' + r.split('_')[-1] + '.png'))
+        if mosaics:
+            h = S.getHole(hname)
+            length = int(dims[0] * boxes)
+            for m, shape in zip(['pole', 'fence'], [(length, dims[1]), (dims[1], length)]):
+                O = h.results.addSub(m)
+                os.makedirs(O.getDirectory(), exist_ok=True)
+                for s in list(sensors) + list(results):
+                    _png(rng, shape, os.path.join(O.getDirectory(), s + '.png'))
+                T = hylite.HyImage(np.zeros((shape[0], shape[1], 1), dtype=np.float32))
+                T.header['depths'] = np.linspace(0, boxes * 5, length)
+                io.save(os.path.join(O.getDirectory(), 'template.hdr'), T)
+            h.save()
+            h.free()
+    S.save()
+    S.createAboutMD(author_name='Benchmark')
+    S.free()
+    return S
+
+def _png( rng, dims, path ):
+    """
+    Write a random RGB png image with the specified (x, y) dimensions.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    Image.fromarray((rng.random((dims[1], dims[0], 3)) * 255).astype(np.uint8)).save(path)
@@ -0,0 +1,166 @@
+"""
+An ASGI variant of the hywiz server, for serving many concurrent viewers from an async server (e.g., uvicorn).
+
+This wraps the flask app created by `hywiz._flask.init(...)`, such that it serves exactly the same routes, but runs each
+request in one of two bounded thread pools: CPU-heavy requests (see `HEAVY`) run in a small render pool, while all
+other requests (tray images, mosaics, legends, the shed index etc.) run in a larger I/O pool. Response bodies (e.g.,
+files) are streamed to clients in chunks from the event loop, such that slow clients do not tie up threads, and many
+concurrent image requests never queue behind a few expensive renders.
+"""
+
+import io
+import sys
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+HEAVY = ('whs', 'get_mosaic_tile', 'getSpectra')
+"""
+Names of the (CPU-heavy) flask endpoints that are run in the render pool.
+"""
+
+CHUNK_SIZE = 256 * 2**10
+"""
+Size (in bytes) of the chunks that files are streamed in.
+"""
+
+class _FileWrapper( object ):
+    """
+    A `wsgi.file_wrapper` that reads files in large chunks, such that each (threaded) read is worth scheduling.
+    """
+    def __init__(self, file, block_size=8192):
+        self.file = file
+        self.block_size = max( block_size, CHUNK_SIZE )
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.file.read( self.block_size )
+        if not data:
+            raise StopIteration()
+        return data
+
+    def close(self):
+        if hasattr( self.file, 'close' ):
+            self.file.close()
+
+class HywizASGI( object ):
+    """
+    An ASGI application that serves a hywiz (flask) app using bounded thread pools.
+    """
+    def __init__(self, app, render_threads : int = 4, io_threads : int = 32):
+        """
+        :param app: The flask app to serve (see `hywiz._flask.init(...)`).
+        :param render_threads: Number of threads used to run CPU-heavy requests (see `HEAVY`). Default is 4.
+        :param io_threads: Number of threads used to run all other requests and to read response bodies. Default is 32.
+        """
+        self.app = app
+        self.render_threads = render_threads
+        self.io_threads = io_threads
+        self._render = ThreadPoolExecutor( max_workers=render_threads, thread_name_prefix='hywiz-render' )
+        self._io = ThreadPoolExecutor( max_workers=io_threads, thread_name_prefix='hywiz-io' )
+
+    def isHeavy(self, path, method='GET'):
+        """
+        Check if a request is CPU-heavy (and should be run in the render pool).
+
+        :param path: The request path.
+        :param method: The request method.
+        :return: True if the path matches one of the endpoints in `HEAVY`.
+        """
+        try:
+            endpoint, _ = self.app.url_map.bind( '' ).match( path, method=method )
+        except Exception:
+            return False # e.g., 404 or 405
+        return endpoint in HEAVY
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send( {'type' : 'lifespan.startup.complete'} )
+                elif message['type'] == 'lifespan.shutdown':
+                    self._render.shutdown( wait=False )
+                    self._io.shutdown( wait=False )
+                    await send( {'type' : 'lifespan.shutdown.complete'} )
+                    return
+        assert scope['type'] == 'http', "Error - unsupported ASGI scope %s" % scope['type']
+
+        # read request body
+        body = b''
+        more = True
+        while more:
+            message = await receive()
+            body += message.get( 'body', b'' )
+            more = message.get( 'more_body', False )
+
+        # run the flask app in the relevant pool
+        loop = asyncio.get_running_loop()
+        pool = self._render if self.isHeavy( scope['path'], scope['method'] ) else self._io
+        status = {}
+        def start_response( s, headers, exc_info=None ):
+            status['code'] = int( s.split(' ')[0] )
+            status['headers'] = [ ( k.lower().encode('latin-1'), v.encode('latin-1') ) for k, v in headers ]
+        result = await loop.run_in_executor( pool, self.app, self.getEnviron( scope, body ), start_response )
+
+        # stream the response
+        try:
+            chunks = iter( result )
+            chunk = await loop.run_in_executor( self._io, next, chunks, None ) # n.b. may call start_response
+            await send( {'type' : 'http.response.start', 'status' : status['code'], 'headers' : status['headers']} )
+            while chunk is not None:
+                if len(chunk) > 0:
+                    await send( {'type' : 'http.response.body', 'body' : chunk, 'more_body' : True} )
+                chunk = await loop.run_in_executor( self._io, next, chunks, None )
+            await send( {'type' : 'http.response.body', 'body' : b'', 'more_body' : False} )
+        finally:
+            if hasattr( result, 'close' ):
+                await loop.run_in_executor( self._io, result.close )
+
+    def getEnviron(self, scope, body=b''):
+        """
+        Convert an ASGI http scope into a WSGI environ dictionary.
+
+        :param scope: The ASGI scope.
+        :param body: The request body.
+        :return: The WSGI environ dictionary.
+        """
+        server = scope.get( 'server', None ) or ( 'localhost', 80 )
+        environ = {
+            'REQUEST_METHOD' : scope['method'],
+            'SCRIPT_NAME' : scope.get( 'root_path', '' ).encode('utf-8').decode('latin-1'),
+            'PATH_INFO' : scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING' : scope.get( 'query_string', b'' ).decode('latin-1'),
+            'SERVER_NAME' : server[0],
+            'SERVER_PORT' : str( server[1] ),
+            'SERVER_PROTOCOL' : 'HTTP/%s' % scope.get( 'http_version', '1.1' ),
+            'REMOTE_ADDR' : ( scope.get( 'client', None ) or ( '', 0 ) )[0],
+            'wsgi.version' : (1, 0),
+            'wsgi.url_scheme' : scope.get( 'scheme', 'http' ),
+            'wsgi.input' : io.BytesIO( body ),
+            'wsgi.errors' : sys.stderr,
+            'wsgi.multithread' : True,
+            'wsgi.multiprocess' : False,
+            'wsgi.run_once' : False,
+            'wsgi.file_wrapper' : _FileWrapper,
+        }
+        for k, v in scope.get( 'headers', [] ):
+            k, v = k.decode('latin-1').upper().replace('-', '_'), v.decode('latin-1')
+            if k not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                k = 'HTTP_' + k
+            environ[k] = environ[k] + ',' + v if k in environ else v
+        return environ
+
+def init( shed, render_threads : int = 4, io_threads : int = 32, **kwds ):
+    """
+    Build an ASGI app that serves the same routes as the flask app returned by `hywiz._flask.init(...)`.
+
+    :param shed: The Shed to serve.
+    :param render_threads: Number of threads used to run CPU-heavy requests (e.g., /whs renders). Default is 4.
+    :param io_threads: Number of threads used to run all other requests. Default is 32.
+    :keywords: Keywords are passed to `hywiz._flask.init(...)`.
+    :return: A `HywizASGI` instance.
+    """
+    from hywiz._flask import init as initFlask
+    return HywizASGI( initFlask( shed, **kwds ), render_threads=render_threads, io_threads=io_threads )
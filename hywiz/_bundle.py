@@ -0,0 +1,233 @@
+"""
+Utilities for writing static hywiz sites into (redbean) zip bundles.
+
+Files that are already compressed (PNG, JPEG, WebP, etc.) are stored as-is rather than being recompressed, while text
+assets (javascript, css, json, ...) are deflated at a configurable level. Identical files are only stored once; requests
+for duplicates are redirected to the stored copy by a small alias table appended to the redbean `.init.lua` script.
+"""
+
+import os
+import re
+import time
+import glob
+import zlib
+import zipfile
+import hashlib
+
+STORED = ('.png', '.jpg', '.jpeg', '.webp', '.avif', '.jxl', '.gif', '.zip', '.gz', '.br', '.woff', '.woff2')
+"""
+Extensions of (already compressed) files that are stored in bundles without further compression.
+"""
+
+TEXT = ('.js', '.css', '.json', '.html', '.htm', '.txt', '.md', '.svg', '.xml', '.dzi', '.map', '.lua')
+"""
+Extensions of text files, which are compressed in bundles.
+"""
+
+ENCODED = ('.webp', '.avif', '.jxl')
+"""
+Extensions of images that may have been re-encoded from PNG files (see `hywiz._static.encodeImage`). Requests for the
+corresponding .png file are redirected to these in bundles.
+"""
+
+ALIAS = """
+-- serve duplicated files from a single stored copy (written by hywiz)
+local ALIASES = {
+%s
+}
+function OnHttpRequest()
+    local target = ALIASES[GetPath()]
+    if target then
+        ServeAsset(target)
+    else
+        Route()
+    end
+end
+"""
+"""
+Lua code appended to .init.lua to redirect requests for duplicate files.
+"""
+
+def getCategory( path ):
+    """
+    Get the category (used to choose compression settings and for reporting) of a file.
+
+    :param path: The file path or name.
+    :return: 'image' (already compressed), 'text' or 'other'.
+    """
+    ext = os.path.splitext( path )[1].lower()
+    if ext in STORED:
+        return 'image'
+    if ext in TEXT:
+        return 'text'
+    return 'other'
+
+def writeBundle( bean, web, prefix='hywiz', compresslevel : int = 6, dedup : bool = True, vb : bool = False ):
+    """
+    Add the files in a static web directory to a (redbean) zip archive.
+
+    :param bean: The zip archive (e.g., a .bean.exe.command file) to append to.
+    :param web: The web directory to bundle. Lua files and files containing `__` are skipped, except
+                for `init.lua`, which is written as `/.init.lua`.
+    :param prefix: The directory within the archive to store files in. Default is 'hywiz'.
+    :param compresslevel: The deflate level (0-9) used to compress text and other uncompressed files. Default is 6.
+    :param dedup: If True (default), files with identical contents are only stored once.
+    :param vb: True if a summary of the bundle contents should be printed.
+    :return: A dictionary with categories ('image', 'text', 'other') as keys and values containing the number of
+             `files`, number of `duplicates`, input `size`, `stored` size (bytes) and `time` (seconds) spent writing them.
+    """
+    stats = { c : dict( files=0, duplicates=0, size=0, stored=0, time=0. ) for c in ['image', 'text', 'other'] }
+    hashes = {}
+    aliases = {}
+    with zipfile.ZipFile( bean, 'a' ) as zf:
+        for f in sorted( glob.glob( os.path.join( web, '**/*.*' ), recursive=True ) ):
+            if (not os.path.isfile(f)) or ('.lua' in f) or ('__' in f):
+                continue
+            t0 = time.perf_counter()
+            name = '/'.join( [prefix] + os.path.relpath( f, web ).split( os.sep ) )
+            cat = getCategory( f )
+            with open( f, 'rb' ) as fh:
+                data = fh.read()
+            stats[cat]['files'] += 1
+            stats[cat]['size'] += len(data)
+            if dedup:
+                h = hashlib.sha1( data ).hexdigest()
+                if h in hashes:
+                    aliases[ '/' + name ] = '/' + hashes[h]
+                    stats[cat]['duplicates'] += 1
+                    stats[cat]['time'] += time.perf_counter() - t0
+                    continue
+                hashes[h] = name
+            info = zipfile.ZipInfo.from_file( f, name )
+            if cat == 'image':
+                info.compress_type = zipfile.ZIP_STORED
+                zf.writestr( info, data )
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zf.writestr( info, data, compresslevel=compresslevel )
+            stats[cat]['stored'] += zf.getinfo( name ).compress_size
+            stats[cat]['time'] += time.perf_counter() - t0
+
+        # redirect requests for .png files to re-encoded images
+        for f in glob.glob( os.path.join( web, '**/*.*' ), recursive=True ):
+            if (os.path.splitext( f )[1].lower() in ENCODED) and not os.path.exists( os.path.splitext( f )[0] + '.png' ):
+                name = '/' + '/'.join( [prefix] + os.path.relpath( f, web ).split( os.sep ) )
+                aliases[ os.path.splitext( name )[0] + '.png' ] = aliases.get( name, name )
+
+        # write init file
+        init = ''
+        if os.path.exists( os.path.join( web, 'init.lua' ) ):
+            with open( os.path.join( web, 'init.lua' ), 'r' ) as f:
+                init = f.read()
+        _setInit( zf, init, aliases, compresslevel )
+
+    if vb:
+        print( "Bundled %d files into %s:" % ( sum( s['files'] for s in stats.values() ), bean ) )
+        for c, s in stats.items():
+            print( "\t %s: %d files (%d duplicates), %.1f MB -> %.1f MB in %.2f s" % (
+                    c, s['files'], s['duplicates'], s['size'] / 2**20, s['stored'] / 2**20, s['time'] ) )
+    return stats
+
+def patchBundle( bean, files : dict = None, remove : list = None, prefix='hywiz', compresslevel : int = 6 ):
+    """
+    Update files in a compiled (redbean) bundle in-place, without rebuilding it. New and modified files are appended
+    to the end of the archive and the central directory is rewritten (such that the size of the update, rather than
+    that of the bundle, determines how long this takes). The space used by replaced or removed files is not reclaimed
+    until the bundle is rebuilt.
+
+    :param bean: The bundle (e.g., a .bean.exe.command file) to update.
+    :param files: A dictionary with paths within the site (e.g., 'map/index.js') as keys and local file paths or bytes
+                  containing the new contents as values. Files with unchanged contents are skipped.
+    :param remove: A list of paths within the site (e.g., 'img/H01/b001/FENIX.png') to remove.
+    :param prefix: The directory within the archive that the site is stored in. Default is 'hywiz'.
+    :param compresslevel: The deflate level (0-9) used to compress text and other uncompressed files. Default is 6.
+    :return: A list of the (site) paths that were added, replaced or removed.
+    """
+    files = {} if files is None else files
+    remove = [] if remove is None else remove
+    changed = []
+    mode = os.stat( bean ).st_mode
+    os.chmod( bean, mode | 0o200 )  # n.b. compiled bundles are read-only
+    try:
+        with zipfile.ZipFile( bean, 'a' ) as zf:
+            init, aliases = _getInit( zf )
+            def arcname( p ):
+                return '/'.join( [prefix] + p.replace( os.sep, '/' ).strip('/').split('/') )
+
+            # find files that actually need to change
+            update = {}
+            for k, v in files.items():
+                if not isinstance( v, bytes ):
+                    with open( v, 'rb' ) as f:
+                        v = f.read()
+                name = arcname( k )
+                info = zf.NameToInfo.get( aliases.get( '/' + name, '/' + name )[1:], None )
+                if (info is None) or (info.file_size != len(v)) or (info.CRC != zlib.crc32(v)):
+                    update[name] = v
+                    changed.append( k )
+            drop = [ arcname( k ) for k in remove if ( arcname(k) in zf.NameToInfo ) or ( '/' + arcname(k) in aliases ) ]
+            changed += [ k for k in remove if arcname(k) in drop ]
+            if len(changed) == 0:
+                return changed
+
+            # files that are about to be replaced or removed can no longer be used as the source of duplicates;
+            # give these to the first duplicate instead
+            for name in list( update.keys() ) + drop:
+                aliases.pop( '/' + name, None )
+                dups = sorted( k for k, v in aliases.items() if (v == '/' + name) and (k[1:] not in drop)
+                               and ( os.path.splitext(k)[1] == os.path.splitext(name)[1] ) ) # n.b. skip .png fallbacks
+                if name in drop: # remove fallbacks to removed files
+                    aliases = { k : v for k, v in aliases.items() if v != '/' + name or k in dups }
+                if (len(dups) > 0) and (name in zf.NameToInfo):
+                    if dups[0][1:] not in update:
+                        update[ dups[0][1:] ] = zf.read( name )
+                    for d in dups:
+                        aliases[d] = dups[0]
+                    aliases.pop( dups[0] )
+
+            # remove old entries from the central directory and write new ones
+            for name in list( update.keys() ) + drop:
+                if name in zf.NameToInfo:
+                    zf.filelist.remove( zf.NameToInfo.pop( name ) )
+            for name, data in update.items():
+                info = zipfile.ZipInfo( name, date_time=time.localtime()[:6] )
+                info.external_attr = 0o644 << 16
+                if getCategory( name ) == 'image':
+                    info.compress_type = zipfile.ZIP_STORED
+                    zf.writestr( info, data )
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    zf.writestr( info, data, compresslevel=compresslevel )
+            _setInit( zf, init, aliases, compresslevel )
+            zf._didModify = True  # ensure the central directory is rewritten even if we only removed files
+    finally:
+        os.chmod( bean, mode )
+    return changed
+
+def _getInit( zf ):
+    """
+    Get the contents of the .init.lua file in a bundle, and the table of duplicate files defined in it.
+
+    :return: A tuple containing the init script (without the alias table) and a dictionary of aliases.
+    """
+    if '.init.lua' not in zf.NameToInfo:
+        return '', {}
+    init = zf.read( '.init.lua' ).decode( 'utf-8' )
+    marker = ALIAS.split( '\n' )[1]
+    if marker not in init:
+        return init, {}
+    init, table = init.split( marker )
+    return init.rstrip( '\n' ), dict( re.findall( r'\["([^"]*)"\] = "([^"]*)"', table ) )
+
+def _setInit( zf, init, aliases, compresslevel=6 ):
+    """
+    Write a .init.lua file (and, if needed, a table of duplicate files) to a bundle.
+    """
+    if len(aliases) > 0:
+        init += ALIAS % ',\n'.join( '    ["%s"] = "%s"' % (k, v) for k, v in sorted( aliases.items() ) )
+    if '.init.lua' in zf.NameToInfo:
+        if zf.read( '.init.lua' ).decode( 'utf-8' ) == init:
+            return # no change
+        zf.filelist.remove( zf.NameToInfo.pop( '.init.lua' ) )
+    if len(init) > 0:
+        zf.writestr( '.init.lua', init, compress_type=zipfile.ZIP_DEFLATED, compresslevel=compresslevel )
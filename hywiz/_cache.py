@@ -0,0 +1,322 @@
+"""
+Utilities for caching expensive products derived from a shed (e.g., the shed index) so that these are only rebuilt
+when the underlying files on disk change.
+"""
+
+import os
+import json
+import time
+import hashlib
+import weakref
+import threading
+from hywiz._metrics import timer
+
+FRAGMENT = '.hywiz'
+"""
+Name of the sidecar file used to store cached index fragments in each box directory.
+"""
+
+IGNORE = (FRAGMENT,)
+"""
+A tuple of file name prefixes that are ignored when computing directory signatures. Files that are written by hywiz
+itself (e.g., cache files) should match one of these so that they do not invalidate the caches that created them.
+"""
+
+def getDirectorySignature( path, ignore=None ):
+    """
+    Compute a signature describing the state of all the files in a directory tree. This only uses file names,
+    modification times and sizes (no file contents are read), so is cheap to compute but will change whenever
+    a file is added, removed or modified.
+
+    :param path: The directory to compute a signature for.
+    :param ignore: A tuple of file name prefixes to ignore. Defaults to None (use `IGNORE`).
+    :return: A hex string that changes whenever files in the directory change.
+    """
+    if ignore is None:
+        ignore = IGNORE
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()  # ensure consistent walk order
+        for f in sorted(files):
+            if f.startswith(ignore):
+                continue
+            try:
+                st = os.stat(os.path.join(root, f))
+            except OSError:
+                continue  # file was removed while we were walking
+            h.update(('%s:%d:%d;' % (os.path.relpath(os.path.join(root, f), path),
+                                     st.st_mtime_ns, st.st_size)).encode('utf-8'))
+    return h.hexdigest()
+
+def getFileIndex( path, ignore=None ):
+    """
+    Build a lookup table mapping file names to their location in a directory tree. If several files share the same
+    name, the first one found (walking the tree top-down, in sorted order) is used.
+
+    :param path: The directory to index.
+    :param ignore: A tuple of file name prefixes to ignore. Defaults to None (use `IGNORE`).
+    :return: A dictionary with file names as keys and full paths as values.
+    """
+    if ignore is None:
+        ignore = IGNORE
+    out = {}
+    for root, dirs, files in os.walk(path):
+        dirs.sort()  # ensure consistent walk order
+        for f in sorted(files):
+            if (f not in out) and not f.startswith(ignore):
+                out[f] = os.path.join(root, f)
+    return out
+
+def getBoxSignature( box ):
+    """
+    Compute a signature describing the state of a box (its header file and all files in its directory).
+
+    :param box: The Box instance to compute a signature for.
+    :return: A hex string that changes whenever the box changes.
+    """
+    sig = getDirectorySignature(box.getDirectory())
+    try:
+        st = os.stat(os.path.splitext(box.getDirectory())[0] + '.hdr')
+        sig += ':%d:%d' % (st.st_mtime_ns, st.st_size)
+    except OSError:
+        pass  # no header file
+    return sig
+
+def getBoxFragment( box, key, builder ):
+    """
+    Get a (cached) fragment of the shed index describing a box. Fragments are stored in a small sidecar file
+    (see `FRAGMENT`) in the box directory, and are reused for as long as the box signature (see `getBoxSignature`)
+    does not change.
+
+    :param box: The Box instance the fragment describes.
+    :param key: A string identifying the fragment (e.g., derived from the arguments used to build it).
+    :param builder: A function (taking no arguments) that builds the fragment if no valid cached version exists.
+                    This must return a json-serialisable object.
+    :return: The (cached) fragment.
+    """
+    sig = getBoxSignature(box)
+    pth = os.path.join(box.getDirectory(), FRAGMENT)
+
+    # load cached fragments
+    cached = {}
+    try:
+        with open(pth, 'r') as f:
+            cached = json.load(f)
+        if cached.get('signature') != sig:
+            cached = {}  # box has changed; fragments are stale
+        elif key in cached.get('fragments', {}):
+            return cached['fragments'][key]
+    except (OSError, ValueError):
+        cached = {}  # no (valid) sidecar file
+
+    # build fragment and store it
+    out = builder()
+    cached['signature'] = sig
+    cached.setdefault('fragments', {})[key] = out
+    tmp = '%s.%d.%d.tmp' % (pth, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(cached, f, separators=(',', ':'))
+        os.replace(tmp, pth)
+    except OSError:
+        pass  # e.g., read-only shed; fragments will simply be rebuilt each time
+    return out
+
+class ShedCache( object ):
+    """
+    A thread-safe store for products derived from a shed (index dictionaries, encoded javascript, etc.). Cached
+    products are rebuilt whenever the signature of the shed directory changes (see `getDirectorySignature`).
+
+    Changes are checked for by a background (watcher) thread, such that requests for cached products never wait for
+    a directory scan, and products are built outside of the cache lock, such that requests never wait for an
+    unrelated product to build. While a product is being rebuilt, other threads are served the previous version of it
+    (rather than waiting), and only wait if no previous version exists.
+    """
+    def __init__(self, shed, interval : float = 1.0, workers : int = 1):
+        """
+        :param shed: The Shed instance to cache products for.
+        :param interval: Number of seconds between (background) checks for changes on disk. Default is 1 second; set
+                         to 0 to instead check on every access (in the thread requesting a product).
+        :param workers: Number of threads used to scan boxes when building the shed index. Default is 1.
+        """
+        self.shed = shed
+        self.interval = interval
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._signature = None
+        self._generation = 0
+        self._checked = 0
+        self._data = {} # key -> (generation, tag, product)
+        self._building = {} # key -> lock held while the product is built
+        self._watcher = None # (pid, thread, stop event) of the background watcher
+
+    def validate(self, force=False):
+        """
+        Check if files in the shed directory have changed and, if so, mark all cached products as out of date.
+
+        :param force: If True, check for changes even if the last check was less than `interval` seconds ago.
+        :return: True if the cache was invalidated.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if (not force) and (self._signature is not None) and (now - self._checked < self.interval):
+                return False
+            self._checked = now # n.b. other threads skip checking while this one scans the directory
+        sig = getDirectorySignature(self.shed.getDirectory())
+        with self._lock:
+            if sig != self._signature:
+                self._signature = sig
+                self._generation += 1
+                return True
+            return False
+
+    def watch(self):
+        """
+        Start the background thread that checks for changes every `interval` seconds (if it is not already running in
+        this process). This is called when products are first requested, so rarely needs to be called directly.
+        """
+        with self._lock:
+            if (self.interval <= 0) or ((self._watcher is not None) and (self._watcher[0] == os.getpid())):
+                return # n.b. threads do not survive forks (e.g., into gunicorn workers), so check the process
+            stop = threading.Event()
+            thread = threading.Thread(target=_watch, args=(weakref.ref(self), self.interval, stop),
+                                      name='hywiz-shed-watcher', daemon=True)
+            self._watcher = (os.getpid(), thread, stop)
+        thread.start()
+
+    def close(self):
+        """
+        Stop the background thread checking for changes (if running).
+        """
+        with self._lock:
+            watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            watcher[2].set()
+
+    def clear(self):
+        """
+        Discard all cached products.
+        """
+        with self._lock:
+            self._signature = None
+            self._generation += 1
+            self._data.clear()
+
+    def get(self, key, builder, tagged=False):
+        """
+        Get a cached product, building it if needed.
+
+        :param key: A hashable key identifying the product.
+        :param builder: A function (taking no arguments) that builds the product if it is not cached.
+        :param tagged: If True, a tag identifying the returned version of the product (derived from the key and the
+                       shed signature it was built for) is also returned. This can be used as an ETag without hashing
+                       the product. Default is False.
+        :return: The (cached) product. If it is out of date and already being rebuilt by another thread, the previous
+                 version is returned. If tagged is True, a (product, tag) tuple is returned.
+        """
+        if (self.interval <= 0) or (self._signature is None):
+            self.validate() # n.b. otherwise changes are checked for by the watcher thread
+        self.watch()
+        entry = self._get(key, builder)
+        return (entry[2], entry[1]) if tagged else entry[2]
+
+    def _get(self, key, builder):
+        """
+        Get the (generation, tag, product) entry of a cached product, building it if needed.
+        """
+        with self._lock:
+            generation, entry = self._generation, self._data.get(key, None)
+            if (entry is not None) and (entry[0] == generation):
+                return entry
+            building = self._building.setdefault(key, threading.Lock())
+        if not building.acquire(blocking=entry is None):
+            return entry  # being rebuilt by another thread; serve the previous version
+        try:
+            with self._lock:  # n.b. may have been built while we waited
+                generation, signature, entry = self._generation, self._signature, self._data.get(key, None)
+                if (entry is not None) and (entry[0] == generation):
+                    return entry
+            tag = hashlib.sha1(('%s:%r' % (signature, key)).encode('utf-8')).hexdigest()
+            entry = (generation, tag, builder())
+            with self._lock:
+                if (key not in self._data) or (self._data[key][0] <= generation):
+                    self._data[key] = entry
+            return entry
+        finally:
+            building.release()
+
+    def index(self, **kwds):
+        """
+        Get a (cached) shed index, as returned by `getShedIndexComplete(...)`.
+
+        :keywords: Keywords are passed to `getShedIndexComplete(...)`.
+        :return: A dictionary containing the shed index. This is shared between callers so should not be modified.
+        """
+        from hywiz._flask import getShedIndexComplete
+        def build():
+            with timer('index'):
+                out = getShedIndexComplete(self.shed, workers=self.workers, **kwds)
+            self.shed.free()  # avoid potential memory leak
+            return out
+        return self.get(('index', _key(kwds)), build)
+
+    def indexJS(self, compress=True, **kwds):
+        """
+        Get a (cached) shed index encoded as javascript, as returned by `getShedIndexJS(...)`.
+
+        :param compress: If True, the returned js file will contain compressed data to reduce file size.
+        :keywords: Keywords are passed to `getShedIndexComplete(...)`.
+        :return: A string containing javascript code to define a data object.
+        """
+        from hywiz._flask import encodeShedIndex
+        return self.get(('js', compress, _key(kwds)),
+                        lambda: encodeShedIndex(self.index(**kwds), compress=compress))
+
+    def shards(self, **kwds):
+        """
+        Get a (cached) sharded shed index, as returned by `splitShedIndex(...)`.
+
+        :keywords: Keywords are passed to `getShedIndexComplete(...)`.
+        :return: A (root, shards) tuple. These are shared between callers so should not be modified.
+        """
+        from hywiz._flask import splitShedIndex
+        return self.get(('shards', _key(kwds)), lambda: splitShedIndex(self.index(**kwds)))
+
+    def files(self):
+        """
+        Get a (cached) lookup table of the files in the shed directory, as returned by `getFileIndex(...)`.
+        """
+        return self.get('files', lambda: getFileIndex(self.shed.getDirectory()))
+
+    def legend(self, name):
+        """
+        Find a (legend) image anywhere in the shed directory using a (cached) lookup table.
+
+        :param name: The file name to look for (including extension).
+        :return: The path to the file, or None if it could not be found.
+        """
+        return self.files().get(name, None)
+
+def _watch( ref, interval, stop ):
+    """
+    Check a ShedCache for changes every interval seconds, until stopped or the cache is garbage collected.
+
+    :param ref: A weak reference to the ShedCache.
+    :param interval: The number of seconds between checks.
+    :param stop: A threading.Event that is set to stop watching.
+    """
+    while not stop.wait(interval):
+        cache = ref()
+        if cache is None:
+            return # cache no longer used
+        try:
+            cache.validate(force=True)
+        except Exception:
+            pass # e.g., shed directory is temporarily unavailable; try again later
+        del cache
+
+def _key( kwds ):
+    """
+    Convert a dictionary of keywords into a hashable key.
+    """
+    return repr(sorted((k, repr(v)) for k, v in kwds.items()))
@@ -10,8 +10,11 @@ a HSI coreshed.
 """
 
 import os
+import time
+import logging
+import importlib
 from flask import Flask, render_template, send_file, abort, url_for, request, Response
-from flask import jsonify, send_from_directory
+from flask import jsonify, send_from_directory, g
 from natsort import natsorted
 import glob
 import numpy as np
@@ -23,6 +26,37 @@ from PIL import Image
 from hycore import Shed
 
 from hywiz import jsapp
+from hywiz._cache import ShedCache, getBoxFragment
+from hywiz._whs import parseQuery, getSourceTime, getQueryKey, render, probe, probeMany, getPixels, \
+                       WINDOW, getWindow, readWindow, getClipLimits, RenderCache, CubeHandles, CubeCache
+from hywiz._pyramid import TILE_SIZE, getDescriptor, getTile, encodeTile, MosaicImages, openImage
+from hywiz._spectra import getSpectraTime, getSpectraPNG
+from hywiz._http import finalize
+from hywiz._metrics import Metrics, isEnabled, timer, start, stop, getServerTiming
+from hywiz._profile import Profiler
+
+logger = logging.getLogger('hywiz')
+"""
+Logger used for requests and server messages.
+"""
+
+LEGEND_PREFIX = 'LEG'
+"""
+Prefix used to denote legend images in results directories.
+"""
+
+def findLegend(image, files):
+    """
+    Find the legend image that corresponds to a results image.
+    :param image: The file name of the results image.
+    :param files: A list of file names (or paths) in the results directory.
+    :return: The name (without extension) of the matching legend, or '' if no legend was found.
+    """
+    for l in files:
+        l = os.path.splitext(os.path.basename(l))[0]
+        if (LEGEND_PREFIX in l) and (l.split(LEGEND_PREFIX)[-1].lower() in image.lower()):
+            return l
+    return ''
 
 def getBoxesInHole(shed, hole):
     """
@@ -40,7 +74,7 @@ def getBoxesInHole(shed, hole):
             return None
     return [b.name for b in hole.getBoxes()]
 
-def getBoxContents(shed, hole, box, sensors=None, results=None, mask=False):
+def getBoxContents(shed, hole, box, sensors=None, results=None, mask=False, cache=False):
     """
     Get a dictionary describing the contents of the specified box.
     :param shed: A Shed instance containing everything
@@ -49,6 +83,8 @@ def getBoxContents(shed, hole, box, sensors=None, results=None, mask=False):
     :param sensors: Sensors to include. Defaults to None (all sensors).
     :param results: Results to include. Defaults to None (all results).
     :param mask: True if image dimensions should be clipped to masked area.
+    :param cache: True if the result should be stored in (and, if the box has not changed, loaded from) a sidecar
+                  file in the box directory. Default is False.
     :return:
     """
     # parse hole if needed
@@ -65,6 +101,12 @@ def getBoxContents(shed, hole, box, sensors=None, results=None, mask=False):
         except:
             return None
 
+    if cache:
+        key = json.dumps( [ None if sensors is None else list(sensors),
+                            None if results is None else list(results), mask ] )
+        return getBoxFragment( box, key, lambda: getBoxContents( shed, hole, box,
+                                                        sensors=sensors, results=results, mask=mask ) )
+
     # load header and get general data
     out = dict(start = round(box.start,2), end = round(box.end,2) )
 
@@ -88,7 +130,6 @@ def getBoxContents(shed, hole, box, sensors=None, results=None, mask=False):
             out['sensors'][s] = dict(dims=[0,0], leg='')  # image not found.
 
     # get results and legends
-    legend_prefix = 'LEG'
     out['results'] = {}  # keys are results, values are legend images
     rfiles = glob.glob(os.path.join(box.results.getDirectory(), "*.png"))
     for i in rfiles:
@@ -98,17 +139,12 @@ def getBoxContents(shed, hole, box, sensors=None, results=None, mask=False):
                 continue # skip this one
 
         # get results images and corresponding legends
-        if legend_prefix.lower() in os.path.basename(i).lower():
+        if LEGEND_PREFIX.lower() in os.path.basename(i).lower():
             continue  # ignore, for now
         else:
             # find matching legend
             r = os.path.splitext(os.path.basename(i))[0]
-            out['results'][r] = dict(leg='')  # no legend
-            for l in rfiles:
-                l = os.path.splitext(os.path.basename(l))[0]
-                if (legend_prefix in l) and (l.split(legend_prefix)[-1].lower() in os.path.basename(i).lower()):
-                    out['results'][r] = dict(leg=l)
-                    break
+            out['results'][r] = dict(leg=findLegend(os.path.basename(i), rfiles))
 
         # add additional metadata on size
         for k,v in out['results'].items():
@@ -141,17 +177,43 @@ def getShedIndexSimple(shed):
     shed.free()  # avoid potential memory leak
     return out
 
-def getShedIndexComplete( shed, sensors=None, results=None, mask=False):
+def getShedIndexComplete( shed, sensors=None, results=None, mask=False, cache=True, workers=1, pyramid=None,
+                          compact_depths=False):
     """
     Return a dictionary describing the contents of this shed and their contents.
     :param shed: A Shed instance to describe.
-        :param sensors: Sensors to include. Defaults to None (all sensors).
+    :param sensors: Sensors to include. Defaults to None (all sensors).
     :param results: Results to include. Defaults to None (all results).
     :param mask: True if image dimensions should be clipped to masked area.
+    :param cache: True (default) if box descriptions should be reused from (and stored in) sidecar files in each
+                  box directory, such that only boxes that changed since the last call need to be described again.
+    :param workers: Number of threads used to describe boxes concurrently. This can greatly speed up index creation
+                    for sheds stored on e.g., network drives, where this is limited by I/O latency. The output is
+                    identical to that created using the default (1; no threading).
+    :param pyramid: Tile size (in pixels) of the multi-resolution pyramids available for pole and fence mosaics, or None
+                    (default) if mosaics should be loaded as single images. If set, a `pyramid` entry describing the
+                    tile layout (see `hywiz._pyramid`) is added to each mosaic.
+    :param compact_depths: If True, the per-pixel depths of each mosaic are stored in a compact binary form (see
+                           `encodeDepths(...)`) rather than as a list of floats. Default is False.
     :return: A dictionary containing details on all holes, boxes and results in this shed.
     """
     out = getShedIndexSimple( shed )
-    for h in shed.getHoles():
+
+    # describe boxes (optionally in parallel, as this is typically I/O bound)
+    holes = shed.getHoles()
+    boxes = [ (h, b) for h in holes for b in h.getBoxes() ]
+    def describe( hb ):
+        return getBoxContents(shed, hb[0], hb[1], 
+                              sensors=sensors, results=results, mask=mask, cache=cache )
+    if workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor( max_workers=workers ) as pool:
+            contents = list( pool.map( describe, boxes ) ) # n.b. map preserves order
+    else:
+        contents = [ describe(hb) for hb in boxes ]
+    contents = { (h.name, b.name) : c for (h, b), c in zip( boxes, contents ) }
+
+    for h in holes:
         out[h.name] = {}
         # out[h.name]['name'] = h.name  # redundant but useful
         out[h.name]['boxes'] = getBoxesInHole( shed, h )
@@ -171,9 +233,8 @@ def getShedIndexComplete( shed, sensors=None, results=None, mask=False):
                 out[h.name]['annotations'][group][k] = dict(name=name, value=value, type=typ, start=z0, end=z1)
 
         # add boxes
-        for b in h.getBoxes():
-            out[h.name][b.name] = getBoxContents(shed, h, b, 
-                                    sensors=sensors, results=results, mask=mask )
+        for b in out[h.name]['boxes']:
+            out[h.name][b] = contents[(h.name, b)]
 
         # get depth info for mosaics (if present)
         for n in ['pole', 'fence']:
@@ -187,6 +248,10 @@ def getShedIndexComplete( shed, sensors=None, results=None, mask=False):
                 out[h.name][n] = dict( dims = [int(T['samples']), int(T['lines'])] )
                 if 'depths' in T:
                     out[h.name][n]['depths'] = [round(z,4) for z in T.get_list('depths')]
+                    if compact_depths:
+                        out[h.name][n]['depths'] = encodeDepths( out[h.name][n]['depths'] )
+                if pyramid is not None:
+                    out[h.name][n]['pyramid'] = dict( layout='deepzoom', tile=int(pyramid), overlap=0, format='png' )
     
     # also include wavelength information for each sensor
     boxes = shed.getBoxes()
@@ -218,14 +283,22 @@ def getShedIndexJS( shed, compress=False, **kwds ):
     :keywords: Keywords are passed to  getShedIndexComplete(...).
     :return: A string containing javascript code to define a data object.
     """
-    data = getShedIndexComplete(shed, **kwds)
+    return encodeShedIndex( getShedIndexComplete(shed, **kwds), compress=compress )
+
+def encodeShedIndex( index, compress=False ):
+    """
+    Encode a shed index dictionary as a .js script containing data = { ... } for easy loading.
+    :param index: The shed index dictionary, as returned by getShedIndexComplete(...).
+    :param compress: If True, the returned js file will contain compressed data to reduce file size.
+    :return: A string containing javascript code to define a data object.
+    """
     if not compress:
         out = "var data ="
-        out += json.dumps(data, separators=(',', ':'))
+        out += json.dumps(index, separators=(',', ':'))
         out += ";"
     else:
         import base64, zlib
-        bts = json.dumps(data, separators=(',', ':') )
+        bts = json.dumps(index, separators=(',', ':') )
         bts = zlib.compress(bts.encode('utf-8'))
 
         # write a little script that loads our compressed data chunk
@@ -235,6 +308,118 @@ def getShedIndexJS( shed, compress=False, **kwds ):
 
     return out
 
+DEPTH_SCALE = 10000
+"""
+Scale factor used to convert depths to integers in compact depth arrays (such that depths are stored to 0.1 mm).
+"""
+
+def encodeDepths( depths, scale : int = DEPTH_SCALE ):
+    """
+    Encode an array of (per-pixel) depths in a compact form. Depths are scaled and rounded to integers, and the
+    difference between successive values stored as a base64 encoded little-endian int32 buffer. As depths typically
+    increase regularly, this is much smaller (and faster to parse) than a list of floats, especially once compressed.
+
+    :param depths: A list or array of depths.
+    :param scale: The factor to multiply depths with before rounding them to integers.
+    :return: A dictionary describing the encoded depths, that can be decoded using `decodeDepths(...)`.
+    """
+    import base64
+    z = np.round( np.asarray( depths, dtype=np.float64 ) * scale ).astype( np.int64 )
+    dz = np.diff( z, prepend=0 ).astype( '<i4' )
+    return dict( encoding='delta-int32', scale=scale, length=len(dz),
+                 data=base64.b64encode( dz.tobytes() ).decode('ascii') )
+
+def decodeDepths( depths ):
+    """
+    Decode depths encoded using `encodeDepths(...)`. Depths that are not encoded (i.e., lists) are returned unchanged.
+
+    :param depths: A dictionary created by `encodeDepths(...)`.
+    :return: A list of depths.
+    """
+    if not isinstance( depths, dict ):
+        return depths
+    import base64
+    assert depths.get('encoding', None) == 'delta-int32', "Error - unknown depth encoding %s" % depths.get('encoding')
+    dz = np.frombuffer( base64.b64decode( depths['data'] ), dtype='<i4' )
+    assert len(dz) == depths['length'], "Error - depth array has the wrong length."
+    z = np.cumsum( dz.astype( np.int64 ) )
+    ndp = int( np.ceil( np.log10( depths['scale'] ) ) ) # number of decimal places
+    return [ round( v / depths['scale'], ndp ) for v in z.tolist() ]
+
+def decodeShedDepths( index ):
+    """
+    Decode all compact depth arrays (see `encodeDepths(...)`) in a shed index (or shard) back to lists, in-place.
+
+    :param index: The shed index (or hole shard) dictionary.
+    :return: The same index, for convenience.
+    """
+    holes = index.get('holes', None)
+    for h in ( [ index ] if holes is None else [ index[h] for h in holes ] ):
+        for n in ['pole', 'fence']:
+            if isinstance( h, dict ) and isinstance( h.get(n, None), dict ) and ('depths' in h[n]):
+                h[n]['depths'] = decodeDepths( h[n]['depths'] )
+    return index
+
+def splitShedIndex( index ):
+    """
+    Split a shed index into a small root index and one shard per hole, such that viewers can load the details
+    (boxes, annotations, mosaic depths etc.) of each hole only when they are needed.
+
+    :param index: The shed index dictionary, as returned by getShedIndexComplete(...).
+    :return root: A copy of the index in which each hole is replaced by a summary containing its box names, length and
+                  the (relative) name of its shard (`holes/<hole>`).
+    :return shards: A dictionary with hole names as keys and the full description of each hole as values.
+    """
+    holes = index.get('holes', [])
+    root = { k : v for k, v in index.items() if k not in holes }
+    shards = {}
+    for h in holes:
+        shards[h] = index[h]
+        root[h] = dict( boxes=index[h].get('boxes', []), length=index[h].get('length', 0), shard='holes/%s' % h )
+    return root, shards
+
+def mergeShedIndex( root, shards ):
+    """
+    Combine a root index and hole shards (as returned by splitShedIndex(...)) back into a complete shed index.
+
+    :param root: The root index.
+    :param shards: A dictionary with hole names as keys and shards as values.
+    :return: A dictionary containing the complete shed index.
+    """
+    out = dict( root )
+    for h in root.get('holes', []):
+        if h in shards:
+            out[h] = shards[h]
+    return out
+
+def getShedCatalog( shed ):
+    """
+    Get a list of the sensors and results images in this shed, as well as associated legends. Unlike
+    getShedIndexComplete(...), this only lists file names (no images or headers are opened), so is fast
+    even for large sheds.
+
+    :param shed: The Shed instance to catalog.
+    :return sensors: A list of sensor names gathered from the shed.
+    :return results: A dictionary with keys representing result names and values giving the name of the relevant
+                     legend image (or ''), as found in the last box containing each result.
+    """
+    sensors = []
+    results = {}
+    for b in shed.getBoxes():
+        for s in b.getSensors():
+            if str(s) not in sensors:
+                sensors.append(str(s))
+        try:
+            rfiles = [f for f in os.listdir(b.results.getDirectory()) if f.endswith('.png')]
+        except OSError:
+            continue # no results directory
+        for i in rfiles:
+            if LEGEND_PREFIX.lower() in i.lower():
+                continue # this is a legend
+            r = os.path.splitext(i)[0]
+            results[r] = findLegend(i, rfiles) # n.b. the last box wins (as when gathered from the shed index)
+    return sensors, results
+
 def getSensorsAndResults( shed ):
     """
     Get a list of the sensors and results images in this shed, as well as associated legends.
@@ -242,36 +427,61 @@ def getSensorsAndResults( shed ):
     :return sensors: A list of sensor names gathered from the shed.
     :return results: A dictionary with keys representing result names and values giving the location of the relevant legend image.
     """
-    index = getShedIndexComplete( shed )
-    def rfunc( k, v ): # recursively search index for results and sensors
-        sensors = set()
-        results = {}
-        if 'results' in k: # we've found a key we're looking for
-            for r,l in v.items():
-                if r not in results: # don't have a legend for this result yet?
-                    results[r] = l['leg']
-                elif results[r] == '': # don't have a legend for this result yet?
-                    results[r] = l['leg']
-            return sensors, results
-        if 'sensors' in k: # we've found a key we're looking for
-            for s in v.keys():
-                sensors.add(s)
-            return sensors, results
-        
-        # nope; iterate or ignore.
-        if isinstance(v, dict):
-            for _k,_v in v.items():
-                s,r = rfunc(_k,_v)
-                sensors.update( s )
-                results = {**results, **r }
-        return sensors, results
-    sensors, results = rfunc( 'root', index )
-    return list(sensors), results
-
-def init( shed : Shed ):
+    return getShedCatalog( shed )
+
+def init( shed : Shed, interval : float = 1.0, workers : int = 1,
+          render_bytes : int = 64 * 2**20, render_dir : str = None, pyramid : int = None,
+          compact_depths : bool = False, max_age : int = 0, preload : bool = False,
+          cube_bytes : int = 1024 * 2**20, mosaic_bytes : int = 512 * 2**20,
+          metrics : bool = None, server_timing : bool = None,
+          profile : str = None, profile_routes : list = None, profile_rate : float = None ):
     """
     Build a flask app instance ready to be launched.
     :param shed: The Shed to serve.
+    :param interval: Number of seconds between checks for changes to files in the shed directory. Expensive
+                     products (e.g., the shed index) are cached and only rebuilt when such changes are detected. Checks
+                     are run on a background thread, or (if set to 0) on every request.
+    :param workers: Number of threads used to scan boxes when (re)building the shed index. Default is 1.
+    :param render_bytes: Maximum number of bytes used to cache images rendered by the /whs endpoint in memory.
+                         Default is 64 MB.
+    :param render_dir: A directory to spill rendered images evicted from memory to, or None (default) to disable this.
+    :param pyramid: Tile size of the multi-resolution pyramids advertised for pole and fence mosaics in the shed
+                    index, or None (default) to serve these as single images. Tiles are served (in the DeepZoom layout
+                    written by static exports) from `/img/<hole>/pole|fence/<name>_files/<level>/<col>_<row>.png`
+                    regardless.
+    :param compact_depths: True if mosaic depths should be stored in a compact binary form in the shed index (see
+                           `encodeDepths(...)`). Default is False (lists of floats, as expected by the bundled viewer).
+    :param max_age: Number of seconds that clients may reuse responses for without checking if they changed. Default
+                    is 0 (always check). All GET responses carry ETags and support conditional (304) requests, file
+                    responses support byte ranges, and JSON / javascript responses are gzip (or, if the `brotli`
+                    package is installed, brotli) encoded for clients that accept this (see `hywiz._http`).
+    :param preload: If True, the shed index (and derived javascript and shards) are built now rather than on the
+                    first request. This is useful if the app is served by several (forked) worker processes, which
+                    then share these rather than each building them (see `launch(...)`).
+    :param cube_bytes: Maximum number of bytes used to keep hyperspectral images loaded by the /whs endpoint in memory
+                       (see `CubeCache`). Recently used images stay loaded, such that repeated queries on the same box
+                       do not reload it from disk. Default is 1 GB.
+    :param mosaic_bytes: Maximum number of bytes used to keep decoded pole and fence mosaics (and their pyramid levels)
+                         in memory for serving tiles (see `MosaicImages`). Default is 512 MB.
+    :param metrics: True if per-route latency histograms and per-stage timings (e.g., index building, cube loading,
+                    evaluation, normalisation and encoding) should be recorded and served in the Prometheus text format
+                    from `/metrics` (see `hywiz._metrics`). If None (default), this is enabled by setting the
+                    `HYWIZ_METRICS` environment variable to 1. Note that each (gunicorn) worker process records its
+                    own metrics.
+    :param server_timing: True if responses should include a `Server-Timing` header listing the time spent in each
+                          stage, as shown by browser developer tools. If None (default), this is enabled by setting the
+                          `HYWIZ_SERVER_TIMING` environment variable to 1.
+    :param profile: A directory to write profiles of (selected) requests to, or None (default) to disable profiling
+                    (see `hywiz._profile`). If None, this is read from the `HYWIZ_PROFILE` environment variable. When
+                    enabled, a summary of the slowest profiled requests is served from `/profiles`.
+    :param profile_routes: A list of patterns (e.g., `/whs` or `/img/*`) matched against request paths and endpoint
+                           names (e.g., `whs` or `boxmap`) to select the requests that are profiled. If None, these are
+                           read (comma separated) from the `HYWIZ_PROFILE_ROUTES` environment variable, or all requests
+                           are considered.
+    :param profile_rate: The fraction (0 - 1) of selected requests to profile. If None, this is read from the
+                         `HYWIZ_PROFILE_RATE` environment variable, or defaults to 1 (all requests) if routes are
+                         specified and 0.01 (1 in 100) otherwise. Only the profiles of the 50 slowest requests are kept
+                         on disk.
     :return: A flask app.
     """
     app = Flask(__name__,
@@ -279,6 +489,124 @@ def init( shed : Shed ):
                 static_folder=jsapp.root)
     app.config['TEMPLATES_AUTO_RELOAD'] = True
 
+    # cache for expensive products (shed index etc.)
+    cache = ShedCache( shed, interval=interval, workers=workers )
+    cache.files() # build legend lookup table now rather than on the first request
+    app.extensions['hywiz'] = cache
+    renders = RenderCache( max_bytes=render_bytes, directory=render_dir )
+    cubes = CubeHandles()
+    loaded = CubeCache( max_bytes=cube_bytes )
+    mosaics = MosaicImages( max_bytes=mosaic_bytes )
+    tile_size = TILE_SIZE if pyramid is None else int(pyramid)
+    options = dict( pyramid=pyramid, compact_depths=compact_depths ) # passed to getShedIndexComplete(...)
+    encoded = RenderCache( max_bytes=16 * 2**20 ) # compressed responses
+    if preload:
+        cache.index( **options )
+        cache.indexJS( compress=True, **options )
+        cache.shards( **options )
+
+    # record request timings
+    metrics = Metrics() if isEnabled( metrics, 'HYWIZ_METRICS' ) else None
+    server_timing = isEnabled( server_timing, 'HYWIZ_SERVER_TIMING' )
+    if (metrics is not None) or server_timing:
+        @app.before_request
+        def startTiming():
+            start()
+
+        @app.after_request # n.b. registered first so that it runs last
+        def stopTiming(response):
+            total, stages = stop()
+            if total is None:
+                return response
+            if metrics is not None:
+                route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+                metrics.observe( route, request.method, response.status_code, total, stages )
+            if server_timing:
+                response.headers['Server-Timing'] = getServerTiming( total, stages )
+            return response
+
+        @app.teardown_request
+        def clearTiming(exc):
+            stop() # n.b. requests that raised an exception skip stopTiming(...)
+
+    if metrics is not None:
+        @app.route('/metrics', methods=['GET'])
+        def getMetrics():
+            """
+            :return: Request and stage timings in the Prometheus text format.
+            """
+            gauges = dict( hywiz_cube_cache_bytes=( 'Bytes of hyperspectral images kept in memory.', loaded.size ),
+                           hywiz_cube_cache_images=( 'Number of hyperspectral images kept in memory.', len(loaded) ),
+                           hywiz_mosaic_cache_bytes=( 'Bytes of decoded mosaics kept in memory.', mosaics.size ) )
+            return Response( metrics.render( gauges ), content_type='text/plain; version=0.0.4; charset=utf-8' )
+
+    # profile selected requests
+    profile = profile if profile is not None else os.environ.get( 'HYWIZ_PROFILE', None )
+    if profile:
+        if profile_routes is None and os.environ.get( 'HYWIZ_PROFILE_ROUTES', '' ).strip():
+            profile_routes = [ r.strip() for r in os.environ['HYWIZ_PROFILE_ROUTES'].split(',') if r.strip() ]
+        if profile_rate is None and os.environ.get( 'HYWIZ_PROFILE_RATE', '' ).strip():
+            profile_rate = float( os.environ['HYWIZ_PROFILE_RATE'] )
+        profiler = Profiler( profile, routes=profile_routes, rate=profile_rate )
+        logger.info( 'Writing request profiles to %s', profiler.directory )
+
+        @app.before_request
+        def startProfile():
+            if ( request.endpoint != 'getProfiles' ) and profiler.select( request.path, request.endpoint ):
+                g.profile = ( profiler.start(), time.perf_counter() )
+
+        @app.after_request # n.b. registered before http(...) such that compression is included
+        def stopProfile(response):
+            profile, t0 = g.pop( 'profile', (None, None) )
+            if profile is not None:
+                params = dict( request.view_args or {} )
+                params.update( request.args.to_dict() )
+                body = request.get_json( silent=True ) if request.method == 'POST' else None
+                if isinstance( body, dict ):
+                    params.update( { k : v for k, v in body.items() if isinstance( v, (str, int, float) ) } )
+                profiler.stop( profile, request.endpoint or 'unmatched', params, time.perf_counter() - t0,
+                               response.status_code )
+            return response
+
+        @app.teardown_request
+        def clearProfile(exc):
+            profile, t0 = g.pop( 'profile', (None, None) )
+            if profile is not None: # n.b. requests that raised an exception skip stopProfile(...)
+                profiler.stop( profile, request.endpoint or 'unmatched', dict( request.view_args or {} ),
+                               time.perf_counter() - t0, 500 )
+
+        @app.route('/profiles', methods=['GET'])
+        def getProfiles():
+            """
+            :return: A JSON summary of the slowest profiled requests. The number of requests listed can be limited
+                     using e.g., /profiles?n=10
+            """
+            n = request.args.get( 'n', None, type=int )
+            return jsonify( profiler.summary( n ) )
+
+    # log requests
+    @app.after_request
+    def log(response):
+        logger.info( '%s %s %s %d', request.remote_addr, request.method, request.full_path.rstrip('?'),
+                     response.status_code )
+        return response
+
+    # add caching headers and compress responses
+    @app.after_request
+    def http(response):
+        with timer( 'http' ):
+            return finalize( response, request, encoded, max_age )
+
+    def cached( key, builder, mimetype ):
+        """
+        Respond with a (cached) shed product, tagged with an ETag derived from the shed signature it was built for
+        (such that large products do not need to be hashed on each request).
+        """
+        out, etag = cache.get( key, builder, tagged=True )
+        response = Response( out, mimetype=mimetype )
+        response.set_etag( etag )
+        return response
+
     # setup HTTP requests
     @app.route('/map', methods=['GET'])
     @app.route('/map/', methods=['GET'])
@@ -288,9 +616,7 @@ def init( shed : Shed ):
         :return: A JSON file with all the holes in this shed. Each hole will contain a list of box objects flagging
                  their name, UID, start depth and to depth.
         """
-        out = getShedIndexSimple(shed)
-        shed.free()  # avoid potential memory leak
-        return jsonify(out)
+        return cached( 'map.json', lambda: app.json.dumps( getShedIndexSimple(shed) ), app.json.mimetype )
 
     @app.route('/map/<hole>', methods=['GET'])
     @app.route('/map/<hole>/', methods=['GET'])
@@ -306,7 +632,6 @@ def init( shed : Shed ):
             return abort(404)
 
         out = getBoxesInHole(shed, hole)
-        shed.free()  # avoid potential memory leak
         return jsonify(out)
 
     @app.route('/map/<hole>/<box>', methods=['GET'])
@@ -324,7 +649,6 @@ def init( shed : Shed ):
             return abort(404)  # drillcore or box not found
 
         out = getBoxContents(shed, hole, box)
-        shed.free()  # avoid potential memory leak
         return jsonify(out)
 
     @app.route('/map/index')
@@ -349,9 +673,7 @@ def init( shed : Shed ):
            }
         }
         """
-        out = getShedIndexComplete(shed)
-        shed.free()  # avoid potential memory leak
-        return jsonify(out)
+        return cached( 'index.json', lambda: app.json.dumps( cache.index( **options ) ), app.json.mimetype )
 
     @app.route('/map/index.js')
     def indexJS():
@@ -359,18 +681,41 @@ def init( shed : Shed ):
         Get Shed index as a javascript file that declares the data variable. Mirrors functionality
         used by static apps to access data in .json format.
         """
-        out = getShedIndexJS(shed, compress=True)
-        shed.free()
-        return Response( out, mimetype='text/javascript')
+        return cached( 'index.js', lambda: cache.indexJS( compress=True, **options ), 'text/javascript' )
+
+    @app.route('/map/root.json')
+    @app.route('/map/root.js')
+    def indexRoot():
+        """
+        Get the root of the sharded shed index (see `splitShedIndex(...)`), listing holes but not their contents.
+        """
+        root, shards = cache.shards( **options )
+        if request.path.endswith('.js'):
+            return cached( 'root.js', lambda: encodeShedIndex( root, compress=True ), 'text/javascript' )
+        return cached( 'root.json', lambda: app.json.dumps( root ), app.json.mimetype )
+
+    @app.route('/map/holes/<hole>.json')
+    @app.route('/map/holes/<hole>.js')
+    def indexShard(hole):
+        """
+        Get the shard of the shed index describing the specified hole (see `splitShedIndex(...)`).
+        """
+        root, shards = cache.shards( **options )
+        if hole not in shards:
+            return abort(404)
+        if request.path.endswith('.js'):
+            return cached( ('shard.js', hole), lambda: encodeShedIndex( shards[hole], compress=True ),
+                           'text/javascript' )
+        return cached( ('shard.json', hole), lambda: app.json.dumps( shards[hole] ), app.json.mimetype )
 
     @app.route('/leg/<legend>', methods=['GET'])
     @app.route('/leg/<legend>/', methods=['GET'])
     def get_legend( legend ):
         if "." not in legend:
             legend = legend + ".png"
-        pth = glob.glob( os.path.join( shed.getDirectory(), '**/%s'%legend), recursive=True )
-        if len(pth) > 0:
-            return send_file(pth[0])
+        pth = cache.legend( legend )
+        if pth is not None:
+            return send_file(pth)
         return abort(404)
     
     @app.route('/img/<hole>/pole/<image>', methods=['GET'])
@@ -388,42 +733,37 @@ def init( shed : Shed ):
             pth = os.path.join(pth, image)
         except:
             return abort(404)  # mosaic not found
-        shed.free()  # avoid potential memory leak
         return send_file(pth)  # send image :-)
 
-    @app.route('/img/<hole>/<box>/spectra/<sensor>_lib.png')
-    def getSpectraLibrary(hole, box, sensor):
+    @app.route('/img/<hole>/<box>/spectra/<sensor>_lib.png', defaults={'kind' : 'lib'})
+    @app.route('/img/<hole>/<box>/spectra/<sensor>_idx.png', defaults={'kind' : 'idx'})
+    def getSpectra(hole, box, sensor, kind):
+        """
+        :return: The spectral library or index of a box encoded as a PNG image (see `hywiz._spectra`), using the
+                 URLs: img/<hole>/<box>/spectra/<sensor>_lib.png and img/<hole>/<box>/spectra/<sensor>_idx.png
+        """
         try:
-            lib = shed.getHole(hole).getBox(box).spectra.get('%s_lib'%sensor)
+            box = shed.getBox(hole, box)
+            mtime = getSpectraTime( box, sensor, kind )
+            assert mtime is not None
         except:
             return abort(404)
 
-        # serve as PNG image
-        from PIL import Image
-        import io
-        data = np.clip( np.transpose( lib.data, (2,0,1) ) * 255, 0, 255 ).astype(np.uint8)
-        img = Image.fromarray(data)
-        file_object = io.BytesIO()
-        img.save(file_object, 'PNG')
-        file_object.seek(0)
-        return send_file(file_object, mimetype='image/PNG')
-    
-    @app.route('/img/<hole>/<box>/spectra/<sensor>_idx.png')
-    def getSpectraIndex(hole, box, sensor):
-        try:
-            idx = shed.getHole(hole).getBox(box).spectra.get('%s_idx'%sensor)
-        except:
-            return abort(404)
-        
-        # serve as PNG image
-        from PIL import Image
-        import io
-        data= (np.clip( idx.data, 0, 255) * 255 ).astype(np.uint8)
-        img = Image.fromarray(data[...,0].T,'L')
-        file_object = io.BytesIO()
-        img.save(file_object, 'PNG')
-        file_object.seek(0)
-        return send_file(file_object, mimetype='image/PNG')
+        etag = getQueryKey( dict( hole=hole, box=box.name, sensor=sensor, kind=kind ), mtime )
+        if request.if_none_match.contains( etag ):
+            response = Response( status=304 )
+        else:
+            png = renders.get( etag )
+            if png is None:
+                try:
+                    png, mtime = getSpectraPNG( box, sensor, kind )
+                except:
+                    return abort(404)
+                renders.put( etag, png )
+            response = Response( png, mimetype='image/PNG' )
+        response.set_etag( etag )
+        response.last_modified = mtime / 1e9
+        return response
     
     @app.route('/img/<hole>/fence/<image>', methods=['GET'])
     @app.route('/img/<hole>/fence/<image>/', methods=['GET'])
@@ -440,9 +780,72 @@ def init( shed : Shed ):
             pth = os.path.join(pth, image)
         except:
             return abort(404)  # mosaic not found
-        shed.free()  # avoid potential memory leak
         return send_file(pth)  # send image :-)
 
+    def getMosaicPath(hole, mosaic, name):
+        """
+        :return: The path to the specified pole or fence mosaic image, or None if it does not exist.
+        """
+        try:
+            pth = shed.getHole(hole, create=False).results.get(mosaic).getDirectory()
+        except:
+            return None  # hole or mosaic not found
+        pth = os.path.join( pth, name + '.png' )
+        if not os.path.exists(pth):
+            return None
+        return pth
+
+    @app.route('/img/<hole>/pole/<name>.dzi', methods=['GET'], defaults={'mosaic' : 'pole'})
+    @app.route('/img/<hole>/fence/<name>.dzi', methods=['GET'], defaults={'mosaic' : 'fence'})
+    def get_mosaic_descriptor(hole, mosaic, name):
+        """
+        :return: A DeepZoom descriptor for the (tiled) pole or fence mosaic, using the URL: img/<hole>/pole/<name>.dzi
+        """
+        pth = getMosaicPath(hole, mosaic, name)
+        if pth is None:
+            return abort(404)
+        try:
+            with openImage(pth) as im:  # n.b. this only reads the image header
+                W, H = im.size
+        except (OSError, Image.DecompressionBombError):
+            return abort(404)  # image could not be opened (or is too large to tile)
+        return Response( getDescriptor( W, H, tile_size ), mimetype='application/xml' )
+
+    @app.route('/img/<hole>/pole/<name>_files/<int:level>/<int:col>_<int:row>.png',
+               methods=['GET'], defaults={'mosaic' : 'pole'})
+    @app.route('/img/<hole>/fence/<name>_files/<int:level>/<int:col>_<int:row>.png',
+               methods=['GET'], defaults={'mosaic' : 'fence'})
+    def get_mosaic_tile(hole, mosaic, name, level, col, row):
+        """
+        :return: A tile from the multi-resolution pyramid of a pole or fence mosaic, using the
+                 URL: img/<hole>/pole/<name>_files/<level>/<col>_<row>.png
+        """
+        pth = getMosaicPath(hole, mosaic, name)
+        if pth is None:
+            return abort(404)
+        mtime = os.stat(pth).st_mtime_ns
+        etag = getQueryKey( dict( path=pth, level=level, col=col, row=row, tile_size=tile_size ), mtime )
+        if request.if_none_match.contains( etag ):
+            response = Response( status=304 )
+        else:
+            png = renders.get( etag )
+            if png is None:
+                levels = mosaics.get( pth )
+                if levels is None:
+                    return abort(404)
+                try:
+                    with timer( 'tile' ):
+                        tile = getTile( levels, level, col, row, tile_size )
+                except IndexError:
+                    return abort(404)  # tile does not exist
+                with timer( 'encode' ):
+                    png = encodeTile( tile )
+                renders.put( etag, png )
+            response = Response( png, mimetype='image/PNG' )
+        response.set_etag( etag )
+        response.last_modified = mtime / 1e9
+        return response
+
     @app.route('/img/<hole>/<box>/<image>', methods=['GET'])
     @app.route('/img/<hole>/<box>/<image>/', methods=['GET'])
     def get_PNG(hole, box, image):
@@ -467,7 +870,6 @@ def init( shed : Shed ):
         else:
             return abort(404)  # drillcore or box not found
 
-        shed.free()  # avoid potential memory leak
         return send_file(pth)  # send image :-)
 
     @app.route('/img/<hole>/<box>/results/<image>', methods=['GET'])
@@ -489,17 +891,17 @@ def init( shed : Shed ):
     @app.route('/', defaults={'path': ''})
     @app.route('/<path:path>')
     def serve(path):
-        print(jsapp.root, path)
+        logger.debug( 'Serving %s from %s', path, jsapp.root )
         if path != "" and os.path.exists(jsapp.root + '/' + path):
             return send_from_directory(jsapp.root, path)
         else:
             return send_from_directory(jsapp.root, 'index.html')
     
-    @app.route('/whs', methods=['POST'])
-    @app.route('/whs/', methods=['POST'])
+    @app.route('/whs', methods=['GET', 'POST'])
+    @app.route('/whs/', methods=['GET', 'POST'])
     def whs():
         """
-        Process a web-hyperspectral query. This must be passed as a json object with the following format:
+        Process a web-hyperspectral query. This must be passed as a json object (POST) or url query (GET) with the following format:
 
         `let request = { hole : <hole name>,
                      box : <box name> ,
@@ -516,99 +918,174 @@ def init( shed : Shed ):
 
         Alternatively, operation can be "probe", in which case a JSON file containing the spectral profile
         (and associated wavelengths) will be returned. In this case, the request must also include an x and y field.
+        Several spectra can be probed at once by instead including a list of `points` ( [[x1,y1],[x2,y2],...] ), a
+        polyline transect (`line`, in the same format), a rectangle (`rect` = [xmin,ymin,xmax,ymax]) or a `polygon`.
+        If a list of `stats` (e.g., ["mean", "median", "std", "p5", "p95"]) is also given, these statistics will be
+        returned instead of the individual spectra.
 
+        Parts of an image can be rendered by also including a pixel `window` ( [xmin,ymin,xmax,ymax] ) and an optional
+        downsampling `step`, or XYZ-style `tile` indices ( [z, x, y] ) and `tile_size`. In this case only the requested region
+        is read, evaluated and encoded (see `hywiz._whs.getWindow`), while percentile clips are still computed from
+        (an overview of) the whole image such that adjacent windows match.
+
+        Rendered images are cached (see `render_bytes` and `render_dir` in `init(...)`), and returned with ETag and
+        Last-Modified headers such that repeated (conditional) requests can be answered with 304 (not modified).
 
         :return:
         """
-        data = request.json
-
         try:
-            # get data from JSON request
-            hole = data['hole']
-            box = data['box']
-            sensor = data['sensor']
-            op = data['operation']
-
-            if 'probe' in op.lower():
-                x = data.get('x', 0)
-                y = data.get('y', 0)
+            # get data from JSON request or url arguments
+            if request.method == 'POST':
+                query = parseQuery( request.json )
             else:
-                vmin = data.get('vmin', 2)
-                vmax = data.get('vmax', 2)
-                tscale = data.get('tscale', False)
-                method = data.get('method', 'percent')  # clip method, can be "percent" or "absolute"
-                if "abs" in method.lower():  # absolute values [ use float as per hylite notation ]
-                    vmin = float(vmin)
-                    vmax = float(vmax)
-                else:  # percentiles [ use int as per hylite notation ]
-                    vmin = int(vmin)
-                    vmax = int(vmax)
+                query = parseQuery( request.args.to_dict() )
+            op = query['operation']
         except:
             return "Invalid query JSON", 400
 
         try:
-            # load dataset
-            box = shed.getBox(hole, box)
-            data = box.get(sensor)
+            # find dataset
+            box = shed.getBox(query['hole'], query['box'])
+            mtime = getSourceTime( box, query['sensor'] )
+            assert mtime is not None
         except:
             return "Box does not exist", 400
 
         # get a pixel spectra
         if 'probe' in op.lower():
-            out = {}
-            out['wavelength'] = list(data.get_wavelengths().astype(float))
-            out['units'] = 'nm'
-            out['R'] = list(data.data[int(x), int(y), :].astype(float))
+            data = cubes.get( box, query['sensor'] ) # try to read only the relevant spectra
+            if data is None:
+                data = loaded.get( box, query['sensor'] ) # fall back to loading everything
+            if data is None:
+                return "Box does not exist", 400
+            try:
+                with timer( 'probe' ):
+                    if any( k in query for k in ['points', 'line', 'rect', 'polygon', 'stats'] ):
+                        xs, ys = getPixels( query, data.data.shape )
+                        out = probeMany( data, xs, ys, stats=query.get('stats', None) )
+                    else:
+                        out = probe( data, query['x'], query['y'] )
+            except IndexError:
+                return "Invalid pixel coordinates", 400
             return jsonify(out)
 
         # get a false colour image or band ratio
         else:
-            # try:
-            result = data.eval(op)  # evaluate result
-            # except:
-            #    return "Invalid operation", 400
-
-            # apply normalisation
-            if isinstance(vmin, int) and isinstance(vmax, int):
-                result.percent_clip(vmin, vmax, per_band=tscale)
+            # check if the client or our cache already has this image
+            etag = getQueryKey( query, mtime )
+            if request.if_none_match.contains( etag ):
+                response = Response( status=304 )
             else:
-                result.data = (result.data - vmin) / (vmax - vmin)
-            result.data = np.clip(result.data * 255, 0, 255).astype(np.uint8)
-            if result.band_count() == 1:
-                result.data = np.dstack([result.data] * 3)
-            if result.band_count() > 3:
-                result.data = result.data[..., :3]
-
-            box.free()  # avoid possible memory leaks
-            shed.free()  # avoid possible memory leaks
-
-            # serve as PNG image
-            from PIL import Image
-            import io
-            img = Image.fromarray(result.data)
-            file_object = io.BytesIO()
-            img.save(file_object, 'PNG')
-            file_object.seek(0)
-
-            return send_file(file_object, mimetype='image/PNG')
+                png = renders.get( etag )
+                if png is None and any( k in query for k in WINDOW ):
+                    # render only the requested window / tile
+                    data = cubes.get( box, query['sensor'] )
+                    if data is None:
+                        data = loaded.get( box, query['sensor'] ) # fall back to loading everything
+                    if data is None:
+                        return "Box does not exist", 400
+                    try:
+                        window = readWindow( data, *getWindow( query, data.data.shape ) )
+                    except IndexError:
+                        return "Invalid window or tile", 400
+                    vmin, vmax = query['vmin'], query['vmax']
+                    if isinstance(vmin, int) and isinstance(vmax, int): # use clip values from the whole image
+                        ckey = getQueryKey( { k : v for k, v in query.items() if k not in WINDOW }, mtime ) + '-clip'
+                        clip = renders.get( ckey )
+                        if clip is None:
+                            clip = json.dumps( getClipLimits( data, op, vmin, vmax, query['tscale'] ) ).encode('utf-8')
+                            renders.put( ckey, clip )
+                        vmin, vmax = json.loads( clip )
+                    png = render( window, op, vmin, vmax, query['tscale'] )
+                    renders.put( etag, png )
+                elif png is None:
+                    data = loaded.get( box, query['sensor'] )
+                    if data is None:
+                        return "Box does not exist", 400
+                    png = render( data, op, query['vmin'], query['vmax'], query['tscale'] )
+                    renders.put( etag, png )
+                response = Response( png, mimetype='image/PNG' )
+            response.set_etag( etag )
+            response.last_modified = mtime / 1e9
+            return response
 
     return app
 
-def launch( shed : Shed, https=False, port=5555, host="0.0.0.0" ):
+SERVERS = ('flask', 'waitress', 'gunicorn', 'uvicorn')
+"""
+Servers that can be used to run a hywiz app (see `launch(...)`).
+"""
+
+def launch( shed : Shed, https=False, port=5555, host="0.0.0.0", server : str = 'flask',
+            threads : int = 8, processes : int = 1, log_level='INFO', **kwds ):
     """
     Launch a hywiz server that serves HSI data from specified shed (with bubbles!)
 
     :param shed: The Shed directory to serve.
-    :param https: True if an adhoc ssl context should be used to simulate https.
+    :param https: True if an adhoc ssl context should be used to simulate https. This is only supported by the
+                  (development) flask server; use a reverse proxy to add https to the production servers.
+    :param port: The port to serve on. Default is 5555.
+    :param host: The host address to serve on. Default is "0.0.0.0" (all interfaces).
+    :param server: The server to use. Options are 'flask' (default; the single-threaded development server),
+                   'waitress' (a multi-threaded production server that also runs on Windows) or 'gunicorn' (a
+                   multi-process and multi-threaded production server for unix) or 'uvicorn' (an async server that runs
+                   the ASGI variant of the app; see `hywiz._asgi`). These need the (optional) `waitress`, `gunicorn`
+                   or `uvicorn` packages to be installed.
+    :param threads: Number of threads used to handle requests by the production servers (per process). For uvicorn, this
+                    is the number of threads used for CPU-heavy requests (e.g., /whs renders), while file and index
+                    requests use a separate (larger) pool. Default is 8.
+    :param processes: Number of worker processes used by gunicorn. The shed index is built before these are forked,
+                      such that workers share it rather than each building their own. Default is 1.
+    :param log_level: The level (e.g., 'DEBUG', 'INFO' or 'WARNING') at which requests and server messages are logged.
+                      Requests are logged at the 'INFO' level. Default is 'INFO'.
+    :keywords: Keywords are passed to `init(...)`.
     """
-    app = Flask(__name__)
-    app.config['TEMPLATES_AUTO_RELOAD'] = True
+    assert server in SERVERS, "Error - server must be one of %s, not %s" % (SERVERS, server)
+    assert (not https) or (server == 'flask'), \
+        "Error - https is only supported by the flask server. Use a reverse proxy (e.g., nginx) to add it."
+    if not logger.hasHandlers(): # n.b. don't configure (root) logging of applications that launch a server
+        handler = logging.StreamHandler()
+        handler.setFormatter( logging.Formatter( '%(asctime)s %(name)s %(levelname)s: %(message)s' ) )
+        logger.addHandler( handler )
+    logger.setLevel( log_level )
+
+    # check the server is installed (before spending time on building the shed index)
+    if server != 'flask':
+        try:
+            importlib.import_module( server )
+        except ImportError:
+            raise ImportError( "Error - serving with %s requires the %s package. Install it using "
+                               "`pip install hywiz[%s]`." % (server, server, server) ) from None
 
     # init app
-    app = init( shed )
+    app = init( shed, preload=(server != 'flask'), **kwds )
 
     # run it
-    if https:
+    if server == 'waitress':
+        from waitress import serve
+        logger.info( 'Serving %s on http://%s:%d using waitress (%d threads)', shed.name, host, port, threads )
+        serve( app, host=host, port=port, threads=threads )
+    elif server == 'gunicorn':
+        from gunicorn.app.base import BaseApplication
+        class _Gunicorn( BaseApplication ):
+            def load_config(self):
+                for k, v in dict( bind='%s:%d' % (host, port), workers=processes, threads=threads,
+                                  worker_class='gthread', preload_app=True,
+                                  loglevel=logging.getLevelName( logger.level ).lower(),
+                                  accesslog=None ).items():
+                    self.cfg.set( k, v )
+            def load(self):
+                return app
+        logger.info( 'Serving %s on http://%s:%d using gunicorn (%d processes with %d threads)',
+                     shed.name, host, port, processes, threads )
+        _Gunicorn().run()
+    elif server == 'uvicorn':
+        import uvicorn
+        from hywiz._asgi import HywizASGI
+        logger.info( 'Serving %s on http://%s:%d using uvicorn (%d render threads)', shed.name, host, port, threads )
+        uvicorn.run( HywizASGI( app, render_threads=threads ), host=host, port=port,
+                     log_level=logging.getLevelName( logger.level ).lower(), access_log=False )
+    elif https:
         app.run(ssl_context='adhoc', port=port, host=host)
     else:
         app.run(port=port, host=host)
@@ -0,0 +1,114 @@
+"""
+Utilities that add HTTP caching (validators, conditional requests and byte ranges) and content encoding (gzip or
+brotli) to the responses returned by the flask server, such that browsers only download data that actually changed.
+"""
+
+import gzip
+import hashlib
+
+COMPRESSIBLE = ( 'application/json', 'text/javascript', 'application/javascript', 'text/html', 'text/css',
+                 'text/plain', 'application/xml', 'text/xml', 'image/svg+xml' )
+"""
+Mimetypes of responses that are compressed if the client accepts this.
+"""
+
+MIN_SIZE = 1024
+"""
+Responses smaller than this (in bytes) are not worth compressing.
+"""
+
+MAX_HASH_SIZE = 256 * 1024
+"""
+Responses without an ETag that are larger than this (in bytes) are not hashed to create one, as this would be done on
+every request. Large (cached) responses should instead be given an ETag where they are produced.
+"""
+
+def getEncodings():
+    """
+    Get the content encodings that can be used, in order of preference. Brotli is only used if the (optional) `brotli`
+    package is installed.
+
+    :return: A list of encoding names.
+    """
+    try:
+        import brotli
+        return ['br', 'gzip']
+    except ImportError:
+        return ['gzip']
+
+def encode( data, encoding ):
+    """
+    Compress response data.
+
+    :param data: The bytes to compress.
+    :param encoding: The content encoding to use ('gzip' or 'br').
+    :return: The compressed bytes.
+    """
+    if encoding == 'br':
+        import brotli
+        return brotli.compress( data, quality=5 ) # n.b. higher qualities are too slow to compute per request
+    assert encoding == 'gzip', "Error - unknown content encoding %s" % encoding
+    return gzip.compress( data, compresslevel=6, mtime=0 ) # n.b. mtime=0 makes the output deterministic
+
+def finalize( response, request, encoded=None, max_age : int = 0 ):
+    """
+    Add caching headers to a response and, where possible, turn it into a 304 (not modified), 206 (partial content)
+    or compressed response.
+
+    Small responses without an ETag (see `MAX_HASH_SIZE`) are given a strong one based on their contents, while
+    files sent with `send_file(...)` keep the ETag (derived from their modification time and size) that flask gives
+    them, and cached products keep the ETag set where they are produced (e.g., from the shed signature).
+
+    :param response: The flask response to finalize.
+    :param request: The request that the response is for.
+    :param encoded: A `RenderCache` used to store compressed responses (keyed by ETag), such that identical responses
+                    are only compressed once. If None (or for responses without an ETag), responses are compressed on
+                    every request.
+    :param max_age: The number of seconds that clients can reuse responses for before checking if they changed.
+                    Default is 0 (always revalidate, which is cheap as unchanged responses return 304).
+    :return: The finalized response.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return response
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.no_cache = True if max_age <= 0 else None
+    if response.status_code != 200:
+        return response # n.b. 304s and 206s have already been processed
+
+    # add a strong validator
+    if response.get_etag()[0] is None:
+        if response.direct_passthrough or response.is_streamed:
+            return response
+        if len( response.get_data() ) <= MAX_HASH_SIZE:
+            response.set_etag( hashlib.sha1( response.get_data() ).hexdigest() )
+
+    # compress (text) responses if the client accepts this
+    if ( response.mimetype in COMPRESSIBLE ) and ( 'Content-Encoding' not in response.headers ) \
+            and ( 'Range' not in request.headers ):
+        response.vary.add( 'Accept-Encoding' )
+        encoding = request.accept_encodings.best_match( getEncodings() )
+        if encoding is not None:
+            etag = response.get_etag()[0]
+            etag = '%s-%s' % ( etag, encoding ) if etag is not None else None
+            data = encoded.get( etag ) if (encoded is not None) and (etag is not None) else None
+            if data is None:
+                response.direct_passthrough = False # n.b. read files sent with send_file(...)
+                data = response.get_data()
+                if len(data) < MIN_SIZE:
+                    return response.make_conditional( request )
+                data = encode( data, encoding )
+                if (encoded is not None) and (etag is not None):
+                    encoded.put( etag, data )
+            elif response.direct_passthrough and hasattr( response.response, 'close' ):
+                response.response.close() # n.b. the file sent with send_file(...) is not needed
+            response.direct_passthrough = False
+            response.set_data( data )
+            response.headers['Content-Encoding'] = encoding
+            if etag is not None:
+                response.set_etag( etag )
+            return response.make_conditional( request )
+
+    if response.direct_passthrough:
+        return response # n.b. send_file(...) already handles conditional and range requests
+    return response.make_conditional( request, accept_ranges=True, complete_length=len( response.get_data() ) )
@@ -0,0 +1,171 @@
+"""
+Instrumentation for the flask server. This records per-route latency histograms and the time spent in the stages of
+each request (e.g., building the shed index, loading cubes, evaluating, normalising and encoding renders), which are
+exposed in the Prometheus text format (from the `/metrics` endpoint) and as `Server-Timing` response headers.
+
+Stages are timed using `timer(...)`, which is a (cheap) no-op unless a request is being recorded in the current
+thread (see `start(...)` and `stop(...)`), such that library functions can be instrumented without depending on flask.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+BUCKETS = ( 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0 )
+"""
+Upper bounds (in seconds) of the latency histogram buckets.
+"""
+
+_local = threading.local()
+
+def isEnabled( value, variable ):
+    """
+    Check if an (optional) feature is enabled.
+
+    :param value: True or False to explicitly enable or disable the feature, or None to use the environment variable.
+    :param variable: The name of an environment variable that enables the feature if set to 1, true, yes or on.
+    :return: True if the feature is enabled.
+    """
+    if value is not None:
+        return bool( value )
+    return os.environ.get( variable, '' ).strip().lower() in ('1', 'true', 'yes', 'on')
+
+@contextmanager
+def timer( name ):
+    """
+    Time a stage of the request being recorded in this thread (if any).
+
+    :param name: The stage name (e.g., 'load' or 'encode'). Stages that are run several times per request are summed.
+    """
+    stages = getattr( _local, 'stages', None )
+    if stages is None:
+        yield # not recording
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get( name, 0.0 ) + time.perf_counter() - t0
+
+def start():
+    """
+    Start recording a request in this thread.
+    """
+    _local.stages = {}
+    _local.t0 = time.perf_counter()
+
+def stop():
+    """
+    Stop recording a request in this thread.
+
+    :return: A tuple containing the total duration (in seconds) and a dictionary of stage durations, or (None, None)
+             if no request was being recorded.
+    """
+    stages = getattr( _local, 'stages', None )
+    if stages is None:
+        return None, None
+    _local.stages = None
+    return time.perf_counter() - _local.t0, stages
+
+def getServerTiming( total, stages ):
+    """
+    Format request timings as a `Server-Timing` header value.
+
+    :param total: The total duration of the request (in seconds).
+    :param stages: A dictionary of stage durations (in seconds).
+    :return: The header value, with durations in milliseconds.
+    """
+    items = [ '%s;dur=%.2f' % (k, v * 1000) for k, v in stages.items() ]
+    return ', '.join( items + ['total;dur=%.2f' % (total * 1000)] )
+
+class Histogram( object ):
+    """
+    A (cumulative) latency histogram.
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, b in enumerate( self.buckets ):
+            if value <= b:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        """
+        Get the lines describing this histogram in the Prometheus text format.
+        """
+        out = [ '%s_bucket{%s,le="%g"} %d' % (name, labels, b, c) for b, c in zip( self.buckets, self.counts ) ]
+        out.append( '%s_bucket{%s,le="+Inf"} %d' % (name, labels, self.count) )
+        out.append( '%s_sum{%s} %.6f' % (name, labels, self.sum) )
+        out.append( '%s_count{%s} %d' % (name, labels, self.count) )
+        return out
+
+class Metrics( object ):
+    """
+    Thread-safe collection of request and stage timings, that can be rendered in the Prometheus text format.
+    """
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: Upper bounds (in seconds) of the histogram buckets. Default is `BUCKETS`.
+        """
+        self.buckets = buckets
+        self.requests = {} # (route, method) -> Histogram
+        self.statuses = {} # (route, method, status) -> count
+        self.stages = {} # (route, stage) -> Histogram
+        self._lock = threading.Lock()
+
+    def observe(self, route, method, status, duration, stages=None):
+        """
+        Record a request.
+
+        :param route: The route (rule) that served the request. Rules (e.g., `/img/<hole>/<box>/<image>`) rather than
+                      paths are used to keep the number of series bounded.
+        :param method: The request method.
+        :param status: The response status code.
+        :param duration: The total duration of the request (in seconds).
+        :param stages: A dictionary of stage durations (in seconds), or None.
+        """
+        with self._lock:
+            self.requests.setdefault( (route, method), Histogram( self.buckets ) ).observe( duration )
+            k = (route, method, status)
+            self.statuses[k] = self.statuses.get( k, 0 ) + 1
+            for name, t in (stages or {}).items():
+                self.stages.setdefault( (route, name), Histogram( self.buckets ) ).observe( t )
+
+    def render(self, gauges=None):
+        """
+        Render all metrics in the Prometheus text format.
+
+        :param gauges: A dictionary of additional (name : (help, value)) gauges to include (e.g., cache sizes).
+        :return: A string.
+        """
+        out = [ '# HELP hywiz_request_duration_seconds Time taken to serve requests, by route.',
+                '# TYPE hywiz_request_duration_seconds histogram' ]
+        with self._lock:
+            for (route, method), h in sorted( self.requests.items() ):
+                out += h.lines( 'hywiz_request_duration_seconds', 'route="%s",method="%s"' % (_escape(route), method) )
+            out += [ '# HELP hywiz_requests_total Number of requests served, by route and status.',
+                     '# TYPE hywiz_requests_total counter' ]
+            for (route, method, status), n in sorted( self.statuses.items() ):
+                out.append( 'hywiz_requests_total{route="%s",method="%s",status="%d"} %d' % (_escape(route), method,
+                                                                                              status, n) )
+            out += [ '# HELP hywiz_stage_duration_seconds Time spent in each stage of serving a request, by route.',
+                     '# TYPE hywiz_stage_duration_seconds histogram' ]
+            for (route, name), h in sorted( self.stages.items() ):
+                out += h.lines( 'hywiz_stage_duration_seconds', 'route="%s",stage="%s"' % (_escape(route),
+                                                                                          _escape(name)) )
+        for name, (text, value) in (gauges or {}).items():
+            out += [ '# HELP %s %s' % (name, text), '# TYPE %s gauge' % name, '%s %g' % (name, value) ]
+        return '\n'.join( out ) + '\n'
+
+def _escape( value ):
+    """
+    Escape a Prometheus label value.
+    """
+    return str(value).replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' )
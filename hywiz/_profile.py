@@ -0,0 +1,139 @@
+"""
+Opt-in profiling of requests served by the flask server. Selected requests (by route pattern and / or sample rate) are
+run under `cProfile`, and the resulting profiles are written to a directory (with the route, parameters and wall time
+in their file names) such that hot spots in production can be inspected (e.g., using `snakeviz` or `pstats`) without
+modifying or redeploying the server.
+"""
+
+import os
+import re
+import time
+import heapq
+import random
+import cProfile
+import threading
+from fnmatch import fnmatch
+
+def getProfileName( route, params, duration, n=0 ):
+    """
+    Get the file name of a saved profile.
+
+    :param route: The route (or endpoint) that served the request.
+    :param params: A dictionary of request parameters (view arguments and query values).
+    :param duration: The wall time of the request (in seconds).
+    :param n: A counter used to keep file names unique.
+    :return: A file name such as `20240101-120000-0_whs_box=b001_hole=H01_153.2ms.prof`.
+    """
+    params = '_'.join( '%s=%s' % (k, v) for k, v in sorted( params.items() ) )
+    name = '%s-%d_%s_%s' % ( time.strftime( '%Y%m%d-%H%M%S' ), n, route.strip('/') or 'root', params )
+    name = re.sub( r'[^A-Za-z0-9=.,-]+', '_', name ).strip('_')[:160] # n.b. keep names short and portable
+    return '%s_%.1fms.prof' % (name, duration * 1000)
+
+class Profiler( object ):
+    """
+    Profiles selected requests and keeps the profiles of the slowest ones.
+
+    Only one request is profiled at a time (requests arriving while another one is being profiled are served
+    normally), as newer versions of python only allow one active profiler per process. Note that from python 3.12,
+    cProfile records calls in all threads, so profiles captured by threaded servers can include work done for other
+    (concurrent) requests.
+    """
+    def __init__(self, directory : str, routes=None, rate : float = None, keep : int = 50):
+        """
+        :param directory: The directory to write profiles to. This is created if needed.
+        :param routes: A list of patterns (e.g., `/whs` or `/img/*`) matched against request paths and endpoint names,
+                       or None (default) to consider all requests.
+        :param rate: The fraction (0 - 1) of matching requests to profile. If None (default), all matching requests are
+                     profiled if routes are specified, and 1 in 100 requests otherwise.
+        :param keep: The number of (slowest) profiles to keep on disk and list in the summary. Profiles of faster
+                     requests are deleted (or never written) once this many have been captured, such that the disk
+                     space used is bounded. Default is 50.
+        """
+        self.directory = os.path.abspath( directory )
+        os.makedirs( self.directory, exist_ok=True )
+        self.routes = list( routes ) if routes is not None else None
+        if rate is None:
+            rate = 1.0 if self.routes is not None else 0.01
+        self.rate = rate
+        self.keep = keep
+        self.captured = 0
+        self._slowest = [] # heap of (duration, n, record)
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+
+    def select(self, path, endpoint=None):
+        """
+        Check if a request should be profiled.
+
+        :param path: The request path.
+        :param endpoint: The name of the endpoint serving the request, or None.
+        :return: True if the request matches one of `routes` and is sampled.
+        """
+        if self.routes is not None:
+            if not any( fnmatch( path, r ) or ( endpoint is not None and fnmatch( endpoint, r ) )
+                        for r in self.routes ):
+                return False
+        return ( self.rate >= 1 ) or ( random.random() < self.rate )
+
+    def start(self):
+        """
+        Start profiling (in the current thread).
+
+        :return: A running `cProfile.Profile`, or None if another request is already being profiled.
+        """
+        if not self._active.acquire( blocking=False ):
+            return None
+        try:
+            profile = cProfile.Profile()
+            profile.enable()
+        except Exception:
+            self._active.release() # e.g., another profiler is active
+            return None
+        return profile
+
+    def stop(self, profile, route, params, duration, status=200):
+        """
+        Stop profiling a request and write the profile to disk.
+
+        :param profile: The profile returned by `start()`.
+        :param route: The route (or endpoint) that served the request.
+        :param params: A dictionary of request parameters.
+        :param duration: The wall time of the request (in seconds).
+        :param status: The response status code.
+        :return: The path of the written profile, or None if it was not kept (see `keep`).
+        """
+        try:
+            profile.disable()
+        finally:
+            self._active.release()
+        with self._lock:
+            self.captured += 1
+            n = self.captured
+            if (len( self._slowest ) >= self.keep) and (duration <= self._slowest[0][0]):
+                return None # faster than all kept profiles
+        path = os.path.join( self.directory, getProfileName( route, params, duration, n ) )
+        profile.dump_stats( path )
+        record = dict( file=os.path.basename( path ), route=route, params=params, status=status,
+                       duration=duration, time=time.strftime( '%Y-%m-%dT%H:%M:%S' ) )
+        with self._lock:
+            heapq.heappush( self._slowest, (duration, n, record) )
+            evicted = [ heapq.heappop( self._slowest )[2] for i in range( len( self._slowest ) - self.keep ) ]
+        for r in evicted:
+            try:
+                os.remove( os.path.join( self.directory, r['file'] ) )
+            except OSError:
+                pass # already removed
+        return path if os.path.exists( path ) else None
+
+    def summary(self, n : int = None):
+        """
+        Summarise the slowest profiled requests.
+
+        :param n: The maximum number of requests to list, or None (default) for all that are kept.
+        :return: A dictionary that can be returned as json.
+        """
+        with self._lock:
+            slowest = [ r for _, _, r in sorted( self._slowest, key=lambda s: -s[0] ) ]
+            captured = self.captured
+        return dict( directory=self.directory, captured=captured, routes=self.routes, rate=self.rate,
+                     slowest=slowest[:n] if n is not None else slowest )
@@ -0,0 +1,255 @@
+"""
+Utilities for splitting (large) mosaic images into multi-resolution tile pyramids, such that viewers only need to
+load the tiles that are visible at the current zoom level.
+
+Pyramids follow the DeepZoom layout: a `<name>.dzi` descriptor file and a `<name>_files` directory containing one
+subdirectory per level (0 = a single pixel, `levels-1` = full resolution), each containing `<col>_<row>.<format>` tiles.
+Each level is built by halving the level above it (see `getLevelImages(...)`), such that building a whole pyramid
+costs little more than one pass over the full resolution image. Static exports and the flask server build levels in
+the same way, such that the tiles they serve are identical.
+"""
+
+import os
+import io
+import math
+import threading
+from collections import OrderedDict
+from PIL import Image
+from hywiz._metrics import timer
+
+TILE_SIZE = 256
+"""
+Default size (in pixels) of pyramid tiles.
+"""
+
+MAX_PIXELS = 2**30
+"""
+Maximum number of pixels in the mosaic images that are opened to build (or serve) pyramids (see `openImage(...)`).
+Mosaics of long holes are (trusted) images that can be much larger than PIL's default decompression bomb limit.
+"""
+
+DZI = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+       '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="%s" Overlap="%d" TileSize="%d">'
+       '<Size Width="%d" Height="%d"/></Image>\n')
+"""
+Template for DeepZoom descriptor (.dzi) files.
+"""
+
+def getLevels( width, height ):
+    """
+    Get the number of levels in a pyramid built from an image of the specified size.
+
+    :param width: The width of the full resolution image.
+    :param height: The height of the full resolution image.
+    :return: The number of levels, such that level 0 is a single pixel and level `levels-1` is full resolution.
+    """
+    return int( math.ceil( math.log2( max( width, height, 1 ) ) ) ) + 1
+
+def getLevelSize( width, height, level ):
+    """
+    Get the size of the specified pyramid level.
+
+    :param width: The width of the full resolution image.
+    :param height: The height of the full resolution image.
+    :param level: The pyramid level.
+    :return: A (width, height) tuple.
+    """
+    scale = 2 ** ( getLevels( width, height ) - 1 - level )
+    return max( 1, int( math.ceil( width / scale ) ) ), max( 1, int( math.ceil( height / scale ) ) )
+
+def getTileCount( width, height, level, tile_size=TILE_SIZE ):
+    """
+    Get the number of tile columns and rows in the specified pyramid level.
+
+    :return: A (cols, rows) tuple.
+    """
+    w, h = getLevelSize( width, height, level )
+    return int( math.ceil( w / tile_size ) ), int( math.ceil( h / tile_size ) )
+
+def getDescriptor( width, height, tile_size=TILE_SIZE, overlap=0, format='png' ):
+    """
+    Get a DeepZoom (.dzi) descriptor for a pyramid.
+
+    :param width: The width of the full resolution image.
+    :param height: The height of the full resolution image.
+    :param tile_size: The size of each tile, in pixels.
+    :param overlap: The number of pixels by which adjacent tiles overlap.
+    :param format: The file format (extension) of the tiles.
+    :return: A string containing the descriptor XML.
+    """
+    return DZI % ( format, overlap, tile_size, width, height )
+
+def getLevelImages( image ):
+    """
+    Build the levels of a pyramid, from full resolution down to a single pixel, by repeatedly halving the image.
+
+    :param image: The (full resolution) PIL image.
+    :return: A generator yielding (level, image) tuples, starting with the full resolution (top) level.
+    """
+    W, H = image.size
+    for level in range( getLevels( W, H ) - 1, -1, -1 ):
+        size = getLevelSize( W, H, level )
+        if image.size != size:
+            image = image.resize( size, Image.BOX )
+        yield level, image
+
+def getTile( levels, level, col, row, tile_size=TILE_SIZE, overlap=0 ):
+    """
+    Cut a tile from a pyramid.
+
+    :param levels: A list containing the image of each pyramid level (see `getLevelImages(...)`), or a dictionary
+                   with the (level : image) of at least the requested level.
+    :param level: The pyramid level.
+    :param col: The column index of the tile.
+    :param row: The row index of the tile.
+    :param tile_size: The size of each tile, in pixels.
+    :param overlap: The number of pixels by which adjacent tiles overlap.
+    :return: A PIL image containing the tile.
+    """
+    if (level < 0) or (level >= len( levels )):
+        raise IndexError("Invalid pyramid level %d" % level)
+    return cutTile( levels[level], col, row, tile_size, overlap )
+
+def cutTile( image, col, row, tile_size=TILE_SIZE, overlap=0 ):
+    """
+    Cut a tile from the image of a single pyramid level.
+
+    :param image: The PIL image of the pyramid level.
+    :param col: The column index of the tile.
+    :param row: The row index of the tile.
+    :param tile_size: The size of each tile, in pixels.
+    :param overlap: The number of pixels by which adjacent tiles overlap.
+    :return: A PIL image containing the tile.
+    """
+    w, h = image.size
+    cols, rows = int( math.ceil( w / tile_size ) ), int( math.ceil( h / tile_size ) )
+    if (col < 0) or (row < 0) or (col >= cols) or (row >= rows):
+        raise IndexError("Invalid tile %d_%d" % (col, row))
+    x0 = max( 0, col * tile_size - overlap )
+    y0 = max( 0, row * tile_size - overlap )
+    x1 = min( w, (col + 1) * tile_size + overlap )
+    y1 = min( h, (row + 1) * tile_size + overlap )
+    return image.crop( ( x0, y0, x1, y1 ) )
+
+def encodeTile( tile, format='png' ):
+    """
+    Encode a tile image as bytes.
+
+    :param tile: The PIL image to encode.
+    :param format: The image format (extension) to use.
+    :return: The encoded image bytes.
+    """
+    buf = io.BytesIO()
+    tile.save( buf, format=format.upper() )
+    return buf.getvalue()
+
+def openImage( path ):
+    """
+    Open a (potentially very large) mosaic image. PIL's decompression bomb limit (`PIL.Image.MAX_IMAGE_PIXELS`) is
+    raised (if needed) such that images with up to `MAX_PIXELS` pixels can be opened.
+
+    :param path: The path to the image file.
+    :return: The (lazily loaded) PIL image.
+    :raises PIL.Image.DecompressionBombError: If the image has more than `MAX_PIXELS` pixels.
+    """
+    if (Image.MAX_IMAGE_PIXELS is not None) and (Image.MAX_IMAGE_PIXELS < MAX_PIXELS // 2):
+        Image.MAX_IMAGE_PIXELS = MAX_PIXELS // 2 # n.b. PIL raises errors for images twice the size of this limit
+    return Image.open( path )
+
+def buildPyramid( image, outdir, name, tile_size=TILE_SIZE, overlap=0, format='png', **kwds ):
+    """
+    Write a DeepZoom pyramid for an image.
+
+    :param image: The PIL image (or a path to one) to split into tiles.
+    :param outdir: The directory to write the `<name>.dzi` file and `<name>_files` directory in.
+    :param name: The name of the pyramid.
+    :param tile_size: The size of each tile, in pixels.
+    :param overlap: The number of pixels by which adjacent tiles overlap.
+    :param format: The file format (extension) of the tiles.
+    :keywords: Keywords are passed to PIL.Image.save(...) when writing each tile (e.g., quality).
+    :return: The number of tiles written.
+    """
+    if isinstance( image, str ):
+        image = openImage( image )
+    image.load()
+    W, H = image.size
+    n = 0
+    for level, im in getLevelImages( image ):
+        pth = os.path.join( outdir, '%s_files' % name, str(level) )
+        os.makedirs( pth, exist_ok=True )
+        cols, rows = getTileCount( W, H, level, tile_size )
+        for col in range( cols ):
+            for row in range( rows ):
+                cutTile( im, col, row, tile_size, overlap ).save(
+                    os.path.join( pth, '%d_%d.%s' % (col, row, format) ), **kwds )
+                n += 1
+    with open( os.path.join( outdir, '%s.dzi' % name ), 'w' ) as f:
+        f.write( getDescriptor( W, H, tile_size, overlap, format ) )
+    return n
+
+class MosaicImages( object ):
+    """
+    A thread-safe LRU cache of decoded mosaic images and their pyramid levels, bounded by the total number of bytes
+    they use, such that tiles can be cut from them repeatedly without decoding (and downsampling) the (potentially
+    large) source image for every request.
+    """
+    def __init__(self, max_bytes : int = 512 * 2**20):
+        """
+        :param max_bytes: Maximum number of bytes of decoded image data (including all pyramid levels) to keep in
+                          memory. Default is 512 MB. Images larger than this are decoded for each request but never
+                          cached.
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._images = OrderedDict()
+        self._size = 0
+
+    def __len__(self):
+        with self._lock:
+            return len( self._images )
+
+    @property
+    def size(self):
+        """
+        The number of bytes of image data currently held in this cache.
+        """
+        with self._lock:
+            return self._size
+
+    def get(self, path):
+        """
+        Get a decoded image, loading it if it is not in the cache (or has changed on disk).
+
+        :param path: The path to the image file.
+        :return: A list containing the PIL image of each pyramid level (see `getLevelImages(...)`), or None if the
+                 image could not be loaded (e.g., as it has more than `MAX_PIXELS` pixels).
+        """
+        try:
+            key = ( path, os.stat( path ).st_mtime_ns )
+        except OSError:
+            return None
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end( key )
+                return self._images[key]
+        try:
+            with timer( 'load' ):
+                image = openImage( path )
+                image.load()
+                levels = [ im for _, im in getLevelImages( image ) ][::-1]
+        except (OSError, Image.DecompressionBombError):
+            return None
+        nbytes = sum( _nbytes( im ) for im in levels )
+        with self._lock:
+            if (key not in self._images) and (nbytes <= self.max_bytes):
+                self._images[key] = levels
+                self._size += nbytes
+                while self._size > self.max_bytes:
+                    self._size -= sum( _nbytes( im ) for im in self._images.popitem( last=False )[1] )
+        return levels
+
+def _nbytes( image ):
+    """
+    Get the (approximate) number of bytes used by a decoded PIL image.
+    """
+    return image.size[0] * image.size[1] * len( image.getbands() )
@@ -0,0 +1,89 @@
+"""
+Functions for encoding the quantized spectral libraries (`<sensor>_lib`) and indices (`<sensor>_idx`) stored in each
+box as PNG images, such that viewers can reconstruct (approximate) pixel spectra without querying the full
+hyperspectral cube.
+
+The same encoding is used by the flask server and static exports, such that both serve identical spectra. Nothing is
+written into the (hylite) spectra collections of a shed; the flask server caches encoded images with its rendered
+images (see `render_bytes` and `render_dir` in `hywiz._flask.init(...)`).
+"""
+
+import io
+import numpy as np
+from PIL import Image
+from hylite import io as hio
+from hywiz._whs import getSourceTime, findSource
+from hywiz._metrics import timer
+
+KINDS = ('lib', 'idx')
+"""
+The kinds of spectra datasets that can be encoded; libraries (`lib`) and indices (`idx`).
+"""
+
+def encodeLibrary( data ):
+    """
+    Encode a spectral library as a PNG image. Each library spectrum is normalised to a maximum of 1 (to reduce blocky
+    compression artefacts) before being scaled to 0 - 255.
+
+    :param data: The (spectra, percentiles, bands) library array.
+    :return: The PNG image bytes, with bands as rows and spectra as columns.
+    """
+    data = data.astype(np.float32) / np.nanmax( data, axis=(1,2) )[:,None,None] # force max value in each spectra to 1
+    data = np.nan_to_num( data, nan=0, posinf=0, neginf=0 ) # nans are bad!
+    mx = max( np.nanmax( data ), 1.0 ) # normalising factor
+    data = np.clip( np.transpose( data, (2,0,1) ) / mx * 255, 0, 255 ).astype(np.uint8)
+    return _png( Image.fromarray( data ) )
+
+def encodeIndex( data ):
+    """
+    Encode a spectral index (mapping each pixel to a spectrum in the corresponding library) as a PNG image.
+
+    :param data: The (x, y, 1) index array.
+    :return: The PNG image bytes.
+    """
+    data = np.nan_to_num( data, nan=0, posinf=0, neginf=0 ) # nans are bad!
+    assert (np.min(data) >= 0) and (np.max(data) <= 255), \
+        "Error - index references too many (%d) spectra." % np.max(data)
+    data = ( np.clip( data, 0, 255 ) * 255 ).astype(np.uint8) # n.b. this matches hycore's shed.exportQuanta(...)
+    return _png( Image.fromarray( data[...,0].T, 'L' ) )
+
+def getSpectraTime( box, sensor, kind ):
+    """
+    Get the modification time of the source files of a spectral library or index.
+
+    :param box: The Box instance containing the spectra.
+    :param sensor: The sensor name.
+    :param kind: 'lib' or 'idx'.
+    :return: The modification time (in ns), or None if the box contains no such spectra.
+    """
+    try:
+        return getSourceTime( box.spectra, '%s_%s' % (sensor, kind) )
+    except AttributeError:
+        return None # box has no spectra
+
+def getSpectraPNG( box, sensor, kind ):
+    """
+    Get a spectral library or index encoded as a PNG image (see `encodeLibrary(...)` and `encodeIndex(...)`).
+
+    :param box: The Box instance containing the spectra.
+    :param sensor: The sensor name.
+    :param kind: 'lib' or 'idx'.
+    :return: A tuple containing the PNG image bytes and the modification time (in ns) of the source data, which
+             callers can use to key cached copies.
+    """
+    assert kind in KINDS, "Error - kind must be one of %s, not %s" % (KINDS, kind)
+    mtime = getSpectraTime( box, sensor, kind )
+    assert mtime is not None, "Error - box %s has no %s_%s spectra." % (box.name, sensor, kind)
+    with timer( 'load' ):
+        data = hio.load( findSource( box.spectra, '%s_%s' % (sensor, kind) ) ).data # n.b. not stored in the shared box
+    with timer( 'encode' ):
+        png = encodeLibrary( data ) if kind == 'lib' else encodeIndex( data )
+    return png, mtime
+
+def _png( image ):
+    """
+    Encode a PIL image as PNG bytes.
+    """
+    buf = io.BytesIO()
+    image.save( buf, 'PNG' )
+    return buf.getvalue()
@@ -5,6 +5,7 @@ using Jinja
 
 from hycore import loadShed
 import sys, os
+import re
 import glob
 from jinja2 import Template, Environment, DictLoader, PackageLoader
 from natsort import natsorted
@@ -15,17 +16,30 @@ from PIL import Image
 import numpy as np
 import zipfile
 from pathlib import Path
+from io import BytesIO
 
 # get path to static folder
 from hywiz import jsapp
 STATIC = os.path.join( os.path.dirname( jsapp.__file__), 'static' )
 
-def getWebDir(shed, setup=True):
+FORMATS = ('png', 'webp', 'avif', 'jxl')
+"""
+Image formats that exported images can be (re-)encoded as.
+"""
+
+MANIFEST = '.hywiz_manifest.json'
+"""
+Name of the manifest file (written next to the img directory) describing the inputs and parameters used to create
+each exported image, such that later exports only need to update images that changed.
+"""
+
+def getWebDir(shed, setup=True, incremental=False):
     """
     Get the directory being used for building static web visualisations.
 
     :param: shed: The Shed instance being visualised.
     :param setup: True if this directory should be setup by copying e.g. static data files.
+    :param incremental: If True, static data files are only copied if they changed since the last setup.
     :return:
         - web: A path to the output directory for web visualisations.
         - img: A path to the img directory for storing media.
@@ -37,19 +51,36 @@ def getWebDir(shed, setup=True):
 
     if setup:
         # copy static folder into output
-        assert os.path.exists(STATIC), "Error - could not find static data at %s" % STATIC
-        static = os.path.join( web, 'static' )
-        if os.path.exists( static ):
-            shutil.rmtree( static )
-        shutil.copytree(STATIC, os.path.join(web, 'static'))
+        _copyStatic( web, incremental=incremental )
 
         # create img folder
         img = os.path.join(web, 'img')
         os.makedirs(img, exist_ok = True )
     return web, img
 
+def _copyStatic( web, incremental=True ):
+    """
+    Copy the static folder (see `STATIC`) into a web directory. If incremental is True, this is skipped if the
+    static folder has not changed since it was last copied.
+    """
+    assert os.path.exists(STATIC), "Error - could not find static data at %s" % STATIC
+    static = os.path.join( web, 'static' )
+    from hywiz._cache import getDirectorySignature, FRAGMENT
+    sig = getDirectorySignature( STATIC )
+    try:
+        assert incremental
+        with open( os.path.join( static, FRAGMENT ), 'r' ) as f:
+            assert f.read() == sig # static folder is up to date
+    except (OSError, AssertionError):
+        if os.path.exists( static ):
+            shutil.rmtree( static )
+        shutil.copytree( STATIC, static )
+        with open( os.path.join( static, FRAGMENT ), 'w' ) as f:
+            f.write( sig )
+
 def copyWeb( shed, outdir, sensors : list = None, results : dict = None, js=True,
-             mosaic_step : int = 1, tray_step : int = 1, crop : bool = False ):
+             mosaic_step : int = 1, tray_step : int = 1, crop : bool = False, workers : int = 1,
+             pyramid : int = None, format : str = 'png', shards : bool = False, compact_depths : bool = False ):
     """
     Copy web files (index.html and associated javascript / css ) into the output directory. This includes
     constructing a json object (stored as a compressed blob in a .js script) that contains a map of this
@@ -64,35 +95,57 @@ def copyWeb( shed, outdir, sensors : list = None, results : dict = None, js=True
     :param mosaic_step: Downsampling factor for mosaic images to reduce file size. Default is 1 (no downsampling).
     :param tray_step: Downsampling factor for tray images to reduce file size. Default is 1 (no downsampling).
     :param crop: Crop trays to masked areas to reduce file size. Default is False.
+    :param workers: Number of threads used to scan boxes while building the shed index. Default is 1.
+    :param pyramid: Tile size of the mosaic pyramids written by `copyImages(...)`, or None (default) if no pyramids
+                    were written. This is recorded in the shed index so viewers know which tiles are available.
+    :param format: The format that images were exported as by `copyImages(...)`. If this is not 'png', the extension of
+                   each exported image is recorded (as `ext`) in the shed index.
+    :param shards: If True, the index is also written as a small root index (map/root.js) and one shard per hole
+                   (map/holes/<hole>.js), such that viewers can load the details of each hole only when needed (see
+                   `hywiz._flask.splitShedIndex`). The complete index (map/index.js) is still written, as this is
+                   what the bundled viewer loads.
+    :param compact_depths: If True, the per-pixel depths of each mosaic are stored in a compact binary form (see
+                           `hywiz._flask.encodeDepths`). This greatly reduces the size of the index for long holes, but
+                           requires a viewer that can decode them. Default is False.
     :return: A path to the index html file.
     """
 
     # save index.json file
-    from hywiz._flask import getShedIndexComplete, getShedIndexJS
+    from hywiz._flask import getShedIndexComplete, encodeShedIndex, splitShedIndex
     os.makedirs(os.path.join(outdir, 'map'), exist_ok=True)
     pbar = tqdm(total=2, desc="Building map", leave=False)
+    index = getShedIndexComplete( shed, 
+                                  sensors=sensors, 
+                                  results=results,
+                                  mask=crop, workers=workers, pyramid=pyramid,
+                                  compact_depths=compact_depths )
+    if (format != 'png') or (pyramid is not None):
+        _setFormats( index, os.path.join( outdir, 'img' ) )
+    pbar.update(1)
     if js:
-        index = getShedIndexJS( shed, compress=True,
-                               sensors=sensors, 
-                               results=results,
-                               mask=crop  )
-        pbar.update(1)
         with open(os.path.join(outdir, 'map/index.js'), 'w') as f:
-            f.write(index)
+            f.write( encodeShedIndex( index, compress=True ) )
     else:
-        index = getShedIndexComplete( shed, 
-                                    sensors=sensors, 
-                                    results=results,
-                                    mask=crop )
-        pbar.update(1)
         with open( os.path.join(outdir, 'map/index.json'), 'w') as f:
             json.dump( index, f )
+    if shards:
+        root, holes = splitShedIndex( index )
+        os.makedirs(os.path.join(outdir, 'map', 'holes'), exist_ok=True)
+        for n, v in [ ('root', root) ] + [ (root[h]['shard'], v) for h, v in holes.items() ]:
+            if js:
+                with open(os.path.join(outdir, 'map/%s.js' % n), 'w') as f:
+                    f.write( encodeShedIndex( v, compress=True ) )
+            else:
+                with open(os.path.join(outdir, 'map/%s.json' % n), 'w') as f:
+                    json.dump( v, f )
     pbar.close()
     
     # copy other web files
     files = glob.glob(jsapp.root + "/*")
     for f in files:
-        if os.path.isdir(f):
+        if os.path.abspath(f) == os.path.abspath(STATIC):
+            _copyStatic( outdir ) # n.b. only if it changed since the last copy
+        elif os.path.isdir(f):
             shutil.copytree( f, 
                             os.path.join( outdir, os.path.basename(f) ),
                              dirs_exist_ok=True )
@@ -105,8 +158,41 @@ def copyWeb( shed, outdir, sensors : list = None, results : dict = None, js=True
     
     return os.path.join(outdir, 'shedIndex.html')
 
+def _setFormats( index, imgdir ):
+    """
+    Record the extension of (re-encoded) images exported to imgdir in a shed index. Sensor and result entries of
+    each box get an `ext` key, while pole and fence entries get an `ext` dictionary (with images names as keys), for
+    all images that are not PNG files. The `pyramid` entries of pole and fence mosaics are updated to match the
+    format and tile size of the exported (.dzi) pyramids.
+    """
+    for h in index['holes']:
+        for b in index[h]['boxes']:
+            for k, sub in [ ('sensors', ''), ('results', 'results') ]:
+                for n, v in index[h][b].get(k, {}).items():
+                    pth = findImage( os.path.join( imgdir, h, b, sub, n ) )
+                    if (pth is not None) and not pth.endswith('.png'):
+                        v['ext'] = os.path.splitext( pth )[1][1:]
+        for m in ['pole', 'fence']:
+            if m in index[h]:
+                for f in glob.glob( os.path.join( imgdir, h, m, '*.*' ) ):
+                    n, e = os.path.splitext( os.path.basename( f ) )
+                    if e[1:] in FORMATS and (e != '.png'):
+                        index[h][m].setdefault( 'ext', {} )[n] = e[1:]
+                if 'pyramid' in index[h][m]:
+                    for f in glob.glob( os.path.join( imgdir, h, m, '*.dzi' ) ):
+                        with open( f, 'r' ) as dzi:
+                            xml = dzi.read()
+                        fmt = re.search( r'Format="(\w+)"', xml )
+                        tile = re.search( r'TileSize="(\d+)"', xml )
+                        if fmt is not None:
+                            index[h][m]['pyramid']['format'] = fmt.group(1)
+                        if tile is not None:
+                            index[h][m]['pyramid']['tile'] = int( tile.group(1) )
+                        break # n.b. all pyramids of a hole are written with the same settings
+
 def copyImages( shed  , imgdir : str, sensors : list = None, results : dict = None,
-                mosaic_step : int = 1, tray_step : int = 1, crop : bool = False, **kwds ):
+                mosaic_step : int = 1, tray_step : int = 1, crop : bool = False, pyramid : int = None,
+                workers : int = 1, incremental : bool = False, format : str = 'png', quality : int = None, **kwds ):
     """
     Copy .png preview images into the web output directory.
 
@@ -118,6 +204,23 @@ def copyImages( shed  , imgdir : str, sensors : list = None, results : dict = No
     :param mosaic_step: Downsampling factor for mosaic images to reduce file size. Default is 1 (no downsampling).
     :param tray_step: Downsampling factor for tray images to reduce file size. Default is 1 (no downsampling).
     :param crop: Crop trays to masked areas to reduce file size. Default is False.
+    :param pyramid: Tile size (e.g., 256) used to also write a multi-resolution DeepZoom pyramid for each mosaic, such
+                    that viewers only need to load visible tiles (see `hywiz._pyramid`). Pyramids are always built from
+                    the full resolution mosaic (regardless of `mosaic_step`, as their lower levels already provide
+                    downsampled versions), such that they have the same layout as those served by the flask server.
+                    Default is None (no pyramids).
+    :param workers: Number of processes used to export tray images and mosaics. Default is 1 (export everything in
+                    this process). Boxes are exported independently (into temporary directories that are then merged
+                    into `imgdir`), so the output is identical to that created by a single process. Files that fail to
+                    export are reported (and skipped) rather than interrupting the whole export.
+    :param incremental: If True, only boxes and mosaics that changed (or were exported using different parameters) since
+                        the last export into `imgdir` are exported again. This uses a manifest (see `MANIFEST`) that
+                        records the state of the source files and the export parameters, and is written by every export.
+                        Default is False (delete everything in `imgdir` and export all images).
+    :param format: The format to (re-)encode tray, result and mosaic images as. Options are 'png' (default, lossless),
+                   'webp', 'avif' or 'jxl' (if supported by the installed version of PIL). Images with 256 or fewer
+                   colours (e.g., categorical result maps) and spectral libraries are always kept as lossless PNGs.
+    :param quality: The quality (0-100) to encode lossy images with, or None (default) to use the PIL defaults.
     :keywords: keywords are all passed to shed.exportQuanta(...).
     :return:
         - nimg: the total number of images copied.
@@ -134,23 +237,58 @@ def copyImages( shed  , imgdir : str, sensors : list = None, results : dict = No
     elif (results is None):
         _ , results = getSensorsAndResults( shed )
     
+    # load manifest describing the previous export (if any)
+    from hywiz._cache import getBoxSignature
+    mpath = os.path.join( os.path.dirname(imgdir), MANIFEST )
+    manifest = _loadManifest( mpath if incremental else None )
+    assert format in FORMATS, "Error - format should be one of %s, not %s" % (FORMATS, format)
+    if format != 'png':
+        assert ('.' + format) in Image.registered_extensions(), \
+            "Error - this version of PIL cannot write %s images. Try installing a plugin." % format
+    params = json.dumps( dict( sensors=sorted(sensors), results=sorted(results.keys()), crop=crop,
+                               tray_step=tray_step, format=format, quality=quality, kwds=repr(sorted(kwds.items())) ) )
+    if (manifest['params'] is None) or not os.path.exists(imgdir):
+        incremental = False # nothing to reuse
+    boxes = { '%s/%s' % (h.name, b.name) : b for h in shed.getHoles() for b in h.getBoxes() }
+
     # export files and spectral quanta
-    shed.exportQuanta(path=imgdir, clean=True, crop=crop, 
-                      sensors=list(sensors), 
-                      results=list(results.keys()), ss = tray_step,
-                      **kwds )
+    kw = dict( crop=crop, sensors=list(sensors), results=list(results.keys()), ss=tray_step, **kwds )
+    if incremental:
+        if manifest['params'] != params:
+            manifest['boxes'] = {} # export parameters changed, so all boxes need to be exported again
+        stale = [ k for k, b in boxes.items() if (manifest['boxes'].get(k, None) != getBoxSignature(b))
+                                              or not os.path.isdir( os.path.join(imgdir, k) ) ]
+        for k in stale + [ k for k in manifest['boxes'] if k not in boxes ]:
+            shutil.rmtree( os.path.join(imgdir, k), ignore_errors=True ) # remove outdated or deleted boxes
+        done = _exportBoxes( shed, imgdir, stale, workers, format, quality, **kw )
+    elif workers > 1:
+        if os.path.exists( imgdir ):
+            shutil.rmtree( imgdir ) # n.b. this matches shed.exportQuanta( ... )
+        os.makedirs( imgdir )
+        done = _exportBoxes( shed, imgdir, list(boxes.keys()), workers, format, quality, **kw )
+    else:
+        shed.exportQuanta(path=imgdir, clean=True, **kw )
+        _encodeSpectra( shed, imgdir, list(boxes.keys()), crop, tray_step )
+        _encodeImages( imgdir, format, quality )
+        done = list(boxes.keys())
+    manifest['boxes'] = { k : manifest['boxes'][k] for k in boxes if (k in manifest['boxes']) and (k not in done) }
+    manifest['boxes'].update( { k : getBoxSignature( boxes[k] ) for k in done } )
+    manifest['params'] = params
 
     # export legends
+    from hywiz._cache import getFileIndex
+    files = getFileIndex( shed.getDirectory() )
     for k,v in results.items():
-        l = glob.glob( os.path.join( shed.getDirectory(), '**/%s.png' % v ), recursive=True )
-        if len(l) > 0:
+        l = files.get( '%s.png' % v, None )
+        if l is not None:
             os.makedirs(os.path.join(os.path.dirname(imgdir), 'leg'), exist_ok=True)
-            shutil.copy(l[0], os.path.join( os.path.dirname(imgdir), 'leg') )
+            shutil.copy(l, os.path.join( os.path.dirname(imgdir), 'leg') )
 
     # copy any pole or fence mosaics
     # (this matches the /<hole>/pole/<image.png>
     #  and /<hole>/fence/<image.png> endpoints.
-    for h in tqdm(shed.getHoles(),desc="Copying mosaics", leave=False):
+    mosaics = {}
+    for h in shed.getHoles():
         for m in ['pole', 'fence']:
             try:
                 p = h.results.get(m).getDirectory()
@@ -163,28 +301,303 @@ def copyImages( shed  , imgdir : str, sensors : list = None, results : dict = No
             for i in glob.glob( os.path.join(p, '*.png')):
                 name = os.path.splitext( os.path.basename(i) )[0]
                 if (name in sensors) or (name in results): # only get mosaics we're asked too!
-                    if mosaic_step > 1: # subsample?
-                        im = Image.open(i)
-                        im = np.array(im)[::mosaic_step, ::mosaic_step, :]
-                        Image.fromarray(im).save( os.path.join( pth, os.path.basename(i) ) )
-                    else:
-                        shutil.copy(i, pth) # no drama lama
-
-    nimg = len( glob.glob( os.path.join(imgdir,"**/*.png"), recursive=True ) )
+                    st = os.stat(i)
+                    mosaics[ os.path.relpath( os.path.join( pth, os.path.basename(i) ), imgdir ) ] = \
+                        ( i, pth, [ st.st_mtime_ns, st.st_size, mosaic_step, pyramid, format, quality ] )
+
+    # skip mosaics that have not changed since the last export, and remove those that are no longer needed
+    for k in manifest['mosaics']:
+        if (k not in mosaics) and os.path.exists( os.path.join( imgdir, k ) ):
+            _removeMosaic( os.path.join( imgdir, k ) )
+    stale = [ k for k, (i, pth, sig) in mosaics.items() if (not incremental) or (manifest['mosaics'].get(k, None) != sig)
+                                                           or (findImage( os.path.join(imgdir, k) ) is None) ]
+    args = ( mosaic_step, pyramid, format, quality )
+    if workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor( max_workers=workers ) as pool:
+            jobs = { pool.submit( _copyMosaic, *mosaics[k][:2], *args ) : mosaics[k][0] for k in stale }
+            done = _wait( jobs, desc="Copying mosaics" )
+    else:
+        done = [ _copyMosaic( *mosaics[k][:2], *args ) for k in tqdm(stale, desc="Copying mosaics", leave=False) ]
+    done = [ os.path.splitext( os.path.relpath( o, imgdir ) )[0] + '.png' for o in done ]
+    manifest['mosaics'] = { k : v[2] for k, v in mosaics.items() if (k in done) or (k not in stale) }
+
+    # store manifest for the next (incremental) export
+    with open( mpath, 'w' ) as f:
+        json.dump( manifest, f )
+
+    nimg = len( [ f for f in glob.glob( os.path.join(imgdir,"**/*.*"), recursive=True )
+                  if (os.path.splitext(f)[1][1:] in FORMATS) and ('_files' not in f) ] )
     return nimg, list(sensors), results
 
+def _copyMosaic( src, outdir, mosaic_step=1, pyramid=None, format='png', quality=None ):
+    """
+    Copy (and optionally downsample, tile and re-encode) a single mosaic image into the output directory.
+
+    :return: The path to the copied image.
+    """
+    out = os.path.join( outdir, os.path.basename(src) )
+    _removeMosaic( out ) # remove old version and tiles
+    if mosaic_step > 1: # subsample?
+        from hywiz._pyramid import openImage
+        im = openImage(src)
+        im = np.array(im)[::mosaic_step, ::mosaic_step, :]
+        Image.fromarray(im).save( out )
+    else:
+        shutil.copy(src, outdir) # no drama lama
+    if format != 'png' and _isCategorical( out ):
+        format = 'png' # keep lossless
+    if pyramid is not None: # also split the full resolution mosaic into tiles (using the same format as the mosaic)
+        from hywiz._pyramid import buildPyramid
+        name = os.path.splitext( os.path.basename(src) )[0]
+        buildPyramid( src, outdir, name, tile_size=int(pyramid), format=format, **_saveArgs( format, quality ) )
+    return encodeImage( out, format, quality )
+
+def _removeMosaic( path ):
+    """
+    Remove an exported mosaic image (in any format) and its pyramid (if any).
+    """
+    name = os.path.splitext( path )[0]
+    shutil.rmtree( name + '_files', ignore_errors=True )
+    for f in [ name + '.' + e for e in FORMATS ] + [ name + '.dzi' ]:
+        if os.path.exists( f ):
+            os.remove( f )
+
+def findImage( path ):
+    """
+    Find an exported image that may have been re-encoded (see `encodeImage(...)`).
+
+    :param path: The path to the image, with or without extension.
+    :return: The path to the image with the extension of the format it was saved in, or None if it does not exist.
+    """
+    name = os.path.splitext( path )[0]
+    for e in FORMATS:
+        if os.path.exists( name + '.' + e ):
+            return name + '.' + e
+    return None
+
+def _isCategorical( path ):
+    """
+    Return True if an image contains 256 or fewer colours (and so is probably a categorical map).
+    """
+    with Image.open( path ) as im:
+        return im.getcolors( 256 ) is not None
+
+def _saveArgs( format, quality=None ):
+    """
+    Get keywords for PIL.Image.save(...) to encode images with the specified format and quality.
+    """
+    out = {} # n.b. the format itself is inferred from the file extension
+    if format == 'webp':
+        out['method'] = 6 # slower, but smaller files
+    if (format != 'png') and (quality is not None):
+        out['quality'] = int(quality)
+    return out
+
+def encodeImage( path, format='png', quality=None ):
+    """
+    Re-encode an exported PNG image using a different (typically lossy) format. Images with 256 or fewer colours
+    (e.g., categorical result maps) are left as (lossless) PNG files.
+
+    :param path: The PNG image to re-encode. This will be replaced by the re-encoded image.
+    :param format: The format to encode (see `FORMATS`).
+    :param quality: The quality (0-100) to use, or None (default) to use the PIL default.
+    :return: The path to the (re-encoded) image.
+    """
+    if (format == 'png') or _isCategorical( path ):
+        return path
+    out = os.path.splitext( path )[0] + '.' + format
+    with Image.open( path ) as im:
+        im.save( out, **_saveArgs( format, quality ) )
+    os.remove( path )
+    return out
+
+def _encodeImages( path, format='png', quality=None ):
+    """
+    Re-encode all exported PNG images (except spectral libraries) in a directory (see `encodeImage(...)`).
+    """
+    if format == 'png':
+        return
+    for f in glob.glob( os.path.join( path, '**/*.png' ), recursive=True ):
+        if os.path.basename( os.path.dirname( f ) ) != 'spectra': # n.b. these store data, so must be lossless
+            encodeImage( f, format, quality )
+
+def _encodeSpectra( shed, imgdir, boxes, crop=False, ss=1 ):
+    """
+    Replace the spectral libraries and indices exported by shed.exportQuanta(...) with those served by the flask
+    server (see `hywiz._spectra.getSpectraPNG`), such that static and dynamic outputs are identical.
+
+    :param boxes: A list of box keys (hole/box) that were exported into imgdir.
+    :param crop: True if the exported indices were cropped to the masked area of each box.
+    :param ss: The subsampling step applied to the exported indices.
+    """
+    from hywiz._spectra import getSpectraPNG, getSpectraTime, KINDS
+    for k in boxes:
+        b = shed.getBox( *k.split('/') )
+        for f in glob.glob( os.path.join( imgdir, k, 'spectra', '*.png' ) ):
+            sensor, _, kind = os.path.splitext( os.path.basename( f ) )[0].rpartition( '_' )
+            if (kind not in KINDS) or (getSpectraTime( b, sensor, kind ) is None):
+                continue # not (source) spectra; keep the file written by shed.exportQuanta(...)
+            try:
+                png, _ = getSpectraPNG( b, sensor, kind )
+                with Image.open( BytesIO( png ) ) as im:
+                    im.load()
+                if kind == 'idx':
+                    data = np.array( im )
+                    if crop and hasattr( b, 'mask' ):
+                        from hycore.templates import get_bounds
+                        xmin, xmax, ymin, ymax = get_bounds( b.mask )
+                        data = data[ ymin:ymax, xmin:xmax ] # n.b. images are stored as (y, x)
+                    im = Image.fromarray( data[::ss, ::ss], 'L' )
+                    im.save( f, 'PNG' )
+                else:
+                    with open( f, 'wb' ) as o:
+                        o.write( png )
+            except Exception as e: # n.b. the static and dynamic spectra will differ, so report this
+                tqdm.write( "Warning: could not encode spectra %s (keeping those exported by hycore): %s"
+                            % ( f, str(e) ) )
+    shed.free()
+
+class _HoleSubset( object ):
+    """
+    Stand-in for a Hole that exposes only some of its boxes, such that shed.exportQuanta(...) can export individual boxes.
+    """
+    def __init__(self, name, boxes):
+        self.name = name
+        self._boxes = boxes
+    def getBoxes(self):
+        return self._boxes
+
+_SHED = None
+def _initWorker( path ):
+    """
+    Load the shed being exported once in each worker process.
+    """
+    global _SHED
+    _SHED = loadShed( path )
+
+def _exportBox( hole, box, outdir, format='png', quality=None, shed=None, **kwds ):
+    """
+    Export the quanta and images of a single box into a temporary output directory, re-encoding them if needed.
+
+    :return: A tuple containing the box key (hole/box) and the output directory.
+    """
+    if shed is None:
+        shed = _SHED # running in a worker process
+    h = shed.getHole( hole )
+    shed.exportQuanta( path=outdir, holes=[ _HoleSubset( h.name, [ h.getBox( box ) ] ) ], clean=True, **kwds )
+    _encodeSpectra( shed, outdir, [ '%s/%s' % (hole, box) ], kwds.get('crop', False), kwds.get('ss', 1) )
+    _encodeImages( outdir, format, quality )
+    shed.free()
+    return '%s/%s' % (hole, box), outdir
+
+def _merge( src, dst ):
+    """
+    Move the contents of directory src into directory dst, merging any subdirectories that already exist.
+    """
+    for f in os.listdir( src ):
+        s, d = os.path.join( src, f ), os.path.join( dst, f )
+        if os.path.isdir( s ) and os.path.isdir( d ):
+            _merge( s, d )
+        else:
+            shutil.move( s, d )
+
+def _wait( jobs, desc ):
+    """
+    Wait for a dictionary of futures (with file or box names as values) to complete, showing a progress bar
+    and reporting any failures.
+
+    :return: A list containing the outputs of all successful jobs.
+    """
+    from concurrent.futures import as_completed
+    out = []
+    for f in tqdm( as_completed( jobs ), total=len(jobs), desc=desc, leave=False ):
+        try:
+            out.append( f.result() )
+        except Exception as e:
+            tqdm.write( "Warning: could not export %s: %s" % ( jobs[f], str(e) ) )
+    return out
+
+def _exportBoxes( shed, imgdir, boxes, workers=1, format='png', quality=None, **kwds ):
+    """
+    Run shed.exportQuanta(...) for each of the specified boxes (optionally in separate processes), and merge the outputs
+    into imgdir.
+
+    :param boxes: A list of box keys (hole/box) to export.
+    :param format: The format to re-encode exported images as (see `encodeImage(...)`).
+    :param quality: The quality to re-encode exported images with.
+    :return: A list of the box keys that were successfully exported.
+    """
+    import tempfile
+    if len(boxes) == 0:
+        return []
+    tmp = tempfile.mkdtemp( dir=os.path.dirname( imgdir ) ) # same file system, so files can be moved cheaply
+    def out( k ):
+        return os.path.join( tmp, k.replace('/', '_'), os.path.basename( imgdir ) )
+    try:
+        if workers > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor( max_workers=workers, initializer=_initWorker,
+                                      initargs=(shed.getDirectory(),) ) as pool:
+                jobs = { pool.submit( _exportBox, *k.split('/'), out(k), format, quality, **kwds ) : k for k in boxes }
+                done = _wait( jobs, desc="Exporting boxes" )
+        else:
+            done = [ _exportBox( *k.split('/'), out(k), format, quality, shed=shed, **kwds )
+                     for k in tqdm( boxes, desc="Exporting boxes", leave=False ) ]
+        for k, o in done:
+            _merge( o, imgdir )
+    finally:
+        shutil.rmtree( tmp, ignore_errors=True )
+    shed.free()
+    return [ k for k, o in done ]
+
+def _loadManifest( path=None ):
+    """
+    Load a build manifest written by `copyImages(...)`, or return an empty one if it (or path) does not exist.
+    """
+    try:
+        assert path is not None
+        with open( path, 'r' ) as f:
+            out = json.load( f )
+        assert out.get('version', None) == 1
+        return out
+    except (OSError, ValueError, AssertionError):
+        return dict( version=1, params=None, boxes={}, mosaics={} )
+
 def buildWeb(shed, *, compile=True, clean=True, sensors : list = None, results : dict = None, 
-             mosaic_step : int = 1, tray_step : int = 1, crop : bool = False, vb=True, **kwds):
+             mosaic_step : int = 1, tray_step : int = 1, crop : bool = False, workers : int = 1,
+             pyramid : int = None, incremental : bool = False, compresslevel : int = 6, dedup : bool = True,
+             format : str = 'png', quality : int = None, shards : bool = False, compact_depths : bool = False,
+             vb=True, **kwds):
     """
     Build a web output for the given shed using default settings.
     :param shed: The shed to convert to a web visualisation.
     :param compile: True if the resulting static site should be compiled into a cross-platform runnable redbean file. Default is True. 
     :param clean: If True (default) the directory used to assmble the redbean app is deleted. Thas has no effect if compile is False.
+                  If incremental is True, the exported images (and their manifest) are kept (at the cost of the disk
+                  space they use) such that the next build can reuse them.
     :param sensors: A list of sensor names to export to the web directory. If None (default) all sensors will be exported.
     :param results: A dict with result names to export (keys) and corresponding legend names (values). To disable, pass an empty list.
     :param mosaic_step: Downsampling factor for mosaic images to reduce file size. Default is 1 (no downsampling).
     :param tray_step: Downsampling factor for tray images to reduce file size. Default is 1 (no downsampling).
     :param crop: Crop trays to masked areas to reduce file size. Default is False.
+    :param workers: Number of processes used to export images (see `copyImages(...)`) and threads used to scan boxes
+                    while building the shed index. Default is 1.
+    :param pyramid: Tile size (e.g., 256) used to write multi-resolution pyramids for each mosaic, or None (default)
+                    to only export mosaics as single images.
+    :param incremental: If True, images exported by a previous build are reused, and only images whose source files or
+                        export parameters changed are exported again. This is useful for repeated (e.g., nightly)
+                        builds of large sheds. Default is False (all images are exported again).
+    :param compresslevel: Deflate level (0-9) used to compress text assets (javascript, css, json etc.) in the compiled
+                          bundle. Already compressed images are always stored without further compression. Default is 6.
+    :param dedup: If True (default), identical files are only stored once in the compiled bundle (see `hywiz._bundle`).
+    :param format: The format to export tray, result and mosaic images as. Options are 'png' (default), 'webp', 'avif'
+                   or 'jxl' (see `copyImages(...)`). Categorical maps are kept as PNG files. The chosen extension is
+                   recorded in the shed index, and compiled bundles also serve re-encoded images when the .png file is
+                   requested.
+    :param quality: The quality (0-100) of lossy images, or None (default) to use the PIL defaults.
+    :param shards: If True, a sharded copy of the shed index (with one file per hole) is also written (see `copyWeb(...)`).
+    :param compact_depths: If True, mosaic depths are stored in a compact binary form in the shed index (see `copyWeb(...)`).
     :param vb: True if print outputs should be created.
     :keywords: keywords are all passed to copyImages.
 
@@ -192,12 +605,14 @@ def buildWeb(shed, *, compile=True, clean=True, sensors : list = None, results :
     """
 
     # create output directory
-    web, img = getWebDir(shed, setup=True)
+    web, img = getWebDir(shed, setup=True, incremental=incremental)
 
     # copy images
     nimg, sensors, results = copyImages(shed, img, sensors, results, 
                                         mosaic_step=mosaic_step, 
-                                        tray_step=tray_step, crop=crop,**kwds )
+                                        tray_step=tray_step, crop=crop, pyramid=pyramid,
+                                        workers=workers, incremental=incremental,
+                                        format=format, quality=quality, **kwds )
     if vb:
         print("Copied %d images to output directory (%s)." % (nimg, img))
         print("\t Output sensors are: %s" % sensors)
@@ -209,24 +624,25 @@ def buildWeb(shed, *, compile=True, clean=True, sensors : list = None, results :
     # copy html data
     out = copyWeb( shed, web, sensors, results, js=True, 
                                         mosaic_step=mosaic_step, 
-                                        tray_step=tray_step, crop=crop )
+                                        tray_step=tray_step, crop=crop, workers=workers, pyramid=pyramid,
+                                        format=format, shards=shards, compact_depths=compact_depths )
 
     bean = os.path.join( os.path.dirname( web ), "%s.bean.exe.command"%shed.name )
     if compile:
         # and combine everything into a funky redbean thingy!!
-        with zipfile.ZipFile(bean, 'a') as zf:
-            for f in glob.glob(os.path.join(web,'**/*.*'), recursive=True):
-                if (os.path.isfile(f)) \
-                    and ('.lua' not in f) \
-                        and ('__' not in f):
-                        zf.write(f,os.path.join( '/hywiz', os.path.relpath(f,web)) )
-            zf.write(os.path.join(web,'init.lua'),'/.init.lua') # also copy init file
+        from hywiz._bundle import writeBundle
+        writeBundle( bean, web, compresslevel=compresslevel, dedup=dedup, vb=vb )
         
         # set as executable file (unix)
         os.chmod(bean, 0o555) 
 
         # and remove web directory
-        if clean:
+        if clean and incremental:
+            for f in os.listdir( web ): # n.b. keep exported images and their manifest for the next build
+                if f not in ( os.path.basename(img), MANIFEST ):
+                    f = os.path.join( web, f )
+                    shutil.rmtree( f ) if os.path.isdir( f ) else os.remove( f )
+        elif clean:
             shutil.rmtree(web)
 
         return bean
@@ -241,15 +657,40 @@ def loadCompiledShedIndex( path : str ):
 
     :param path: Path to the js file to load. This must be created by `buildWeb(...)` or similar, and is typically located
                  stored as /map/index.js within the relevant site. Optionally the root directory of the site can also be passed,
-                 and the index.js file looked for within this as outlined above.
+                 and the index.js file looked for within this as outlined above. Compiled (.bean.exe.command) sites
+                 can also be passed, in which case the index is read from within the bundle. If the site only contains
+                 a sharded index (/map/root.js and /map/holes/<hole>.js; see `copyWeb(...)`), this is loaded and merged.
     """
-    if ".js" not in path:
+    from hywiz._flask import mergeShedIndex
+    if (".js" in path) and not zipfile.is_zipfile( path ):
+        assert os.path.exists( path ), "Error: File %s does not exist"%path
+        index = _decodeShedIndex( Path(path).read_text() )
+        if os.path.basename( path ) != 'root.js':
+            return index
+        site = os.path.dirname( os.path.dirname( path ) ) # n.b. root.js is stored in <site>/map/
+    else:
         assert os.path.exists( path ), "Error: Path %s does not exist"%path
-        path = os.path.join( path , 'map/index.js')
-    assert os.path.exists( path ), "Error: File %s does not exist"%path
-
-    # read js file and get our compressed blob
-    str = Path(path).read_text()
+        site = path
+        str = _readSite( site, 'map/index.js' )
+        if str is not None:
+            return _decodeShedIndex( str )
+        str = _readSite( site, 'map/root.js' )
+        assert str is not None, "Error: %s does not contain a shed index." % path
+        index = _decodeShedIndex( str )
+
+    # load shards
+    shards = {}
+    for h in index.get('holes', []):
+        str = _readSite( site, 'map/%s.js' % index[h]['shard'] )
+        assert str is not None, "Error: Shard for hole %s is missing." % h
+        shards[h] = _decodeShedIndex( str )
+    return mergeShedIndex( index, shards )
+
+def _decodeShedIndex( str ):
+    """
+    Decode the contents of a (compressed) .js shed index.
+    """
+    # get our compressed blob
     assert "b64=" in str, "Error: Loaded .js file does not contain a valid shed index."
     str=str.split("b64=")[1][1:-2]
     
@@ -259,32 +700,69 @@ def loadCompiledShedIndex( path : str ):
     assert bits[0] == "{", "Error: Loaded .js file does not contain a valid shed index."
     assert bits[-1] == "}", "Error: Loaded .js file does not contain a valid shed index."
 
-    # convert to a dict and return
+    # convert to a dict and return (with compact depth arrays converted back to lists)
     import json
-    return json.loads( bits )
-    
-def compileShedIndex( index, path ):
+    from hywiz._flask import decodeShedDepths
+    return decodeShedDepths( json.loads( bits ) )
+
+def _readSite( site, name ):
+    """
+    Read a text file from a static site directory or compiled (.bean.exe.command) site.
+
+    :return: The file contents, or None if the file does not exist.
+    """
+    if os.path.isfile( site ) and zipfile.is_zipfile( site ):
+        with zipfile.ZipFile( site, 'r' ) as zf:
+            if 'hywiz/' + name not in zf.NameToInfo:
+                return None
+            return zf.read( 'hywiz/' + name ).decode('utf-8')
+    if not os.path.exists( os.path.join( site, name ) ):
+        return None
+    return Path( os.path.join( site, name ) ).read_text()
+
+def compileShedIndex( index, path, shards : bool = None ):
     """
     Compile a shed index dictionary (as returned by `loadCompiledShedIndex(...)`) back to a compressed .js file.
 
     :param index: The index dictionary to compile.
     :param path: The name of the file to compile/save it too. This can be a .js file, or a web directory (see path
-                argument for `loadCompiledShedIndex`).
+                argument for `loadCompiledShedIndex`). If this is a compiled (.bean.exe.command) site, the index in
+                the bundle is replaced in-place (see `hywiz._bundle.patchBundle`).
+    :param shards: True if a sharded index (/map/root.js and /map/holes/<hole>.js) should be written. If None (default),
+                   this is done if the site already contains a sharded index. A complete index (/map/index.js) is
+                   written unless shards is True and the site does not already contain one.
     """
-
-    import base64, zlib
-    bts = json.dumps(index, separators=(',', ':') )
-    bts = zlib.compress(bts.encode('utf-8'))
-
-    # write a little script that loads our compressed data chunk
-    out = 'var b64="'
-    out += str(base64.b64encode(bts))[2:-1]
-    out += '";'
-
-    if ".js" not in path:
-        path = os.path.join( path, 'map/index.js' )
-    with open(path, 'w') as f:
-        f.write(out)
+    from hywiz._flask import encodeShedIndex, splitShedIndex
+
+    if (".js" in path) and not zipfile.is_zipfile( path ):
+        if os.path.basename( path ) != 'root.js': # write a single file
+            with open(path, 'w') as f:
+                f.write( encodeShedIndex( index, compress=True ) )
+            return
+        path = os.path.dirname( os.path.dirname( path ) ) # n.b. root.js is stored in <site>/map/
+        shards = True
+
+    # decide what to write
+    if shards is None:
+        shards = _readSite( path, 'map/root.js' ) is not None
+    files = {}
+    if (not shards) or ( _readSite( path, 'map/index.js' ) is not None ):
+        files['map/index.js'] = encodeShedIndex( index, compress=True )
+    if shards:
+        root, holes = splitShedIndex( index )
+        files['map/root.js'] = encodeShedIndex( root, compress=True )
+        for h, v in holes.items():
+            files['map/%s.js' % root[h]['shard']] = encodeShedIndex( v, compress=True )
+
+    # and write it
+    if os.path.isfile( path ) and zipfile.is_zipfile( path ):
+        from hywiz._bundle import patchBundle
+        patchBundle( path, { k : v.encode('utf-8') for k, v in files.items() } ) # n.b. unchanged shards are skipped
+        return
+    for k, v in files.items():
+        os.makedirs( os.path.dirname( os.path.join( path, k ) ), exist_ok=True )
+        with open( os.path.join( path, k ), 'w' ) as f:
+            f.write(v)
 
 def addAnnotations( path, annot, merge=True):
     """
@@ -293,7 +771,8 @@ def addAnnotations( path, annot, merge=True):
 
     :param path: Path to the js file to load. This must have been created by `buildWeb(...)` or similar, and is typically located
                  stored as /map/index.js within the relevant site. Optionally the root directory of the site can also be passed,
-                 and the index.js file looked for within this as outlined above.
+                 and the index.js file looked for within this as outlined above. Compiled (.bean.exe.command) sites are
+                 updated in-place.
     :param annot: A dictionary or .json file containing the annotation information, in the structure saved by the hywiz viewer.
     :param merge: True if annotations should be combined with any pre-existing ones. If False, other annotation information will be removed
                   before these new ones are added.
@@ -0,0 +1,620 @@
+"""
+Functions for processing web-hyperspectral (whs) queries, i.e. rendering false colour images and band ratios or
+extracting pixel spectra from the hyperspectral data stored in a shed.
+"""
+
+import os
+import glob
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from io import BytesIO
+import hylite
+from hylite import io as hio
+from hywiz._metrics import timer
+
+def parseQuery( data ):
+    """
+    Parse a whs query (as described in the `/whs` endpoint).
+
+    :param data: A dictionary containing the (json or url) query.
+    :return: A dictionary containing the parsed query.
+    """
+    out = dict(hole=data['hole'], box=data['box'], sensor=data['sensor'], operation=data['operation'])
+    if 'probe' in out['operation'].lower():
+        out['x'] = int(data.get('x', 0))
+        out['y'] = int(data.get('y', 0))
+        for k in ['points', 'line', 'rect', 'polygon', 'stats']: # batch / region probes
+            if k in data:
+                out[k] = _list( data[k] )
+        if 'rect' in out:
+            out['rect'] = [int(v) for v in out['rect']]
+            assert len(out['rect']) == 4, "Error - rect must be [xmin, ymin, xmax, ymax]"
+        for k in ['points', 'line', 'polygon']:
+            if k in out:
+                out[k] = [[float(p[0]), float(p[1])] for p in out[k]]
+        if 'stats' in out:
+            if isinstance(out['stats'], str):
+                out['stats'] = [out['stats']]
+            for k in out['stats']:
+                assert (k in STATS) or (k[0] == 'p' and 0 <= float(k[1:]) <= 100), "Error - unknown statistic %s" % k
+    else:
+        vmin = data.get('vmin', 2)
+        vmax = data.get('vmax', 2)
+        tscale = data.get('tscale', False)
+        if isinstance(tscale, str): # e.g., from url query
+            tscale = tscale.lower() in ['1', 'true', 'yes']
+        method = data.get('method', 'percent')  # clip method, can be "percent" or "absolute"
+        if "abs" in method.lower():  # absolute values [ use float as per hylite notation ]
+            vmin = float(vmin)
+            vmax = float(vmax)
+        else:  # percentiles [ use int as per hylite notation ]
+            vmin = int(vmin)
+            vmax = int(vmax)
+        out.update(vmin=vmin, vmax=vmax, tscale=bool(tscale), method=method)
+
+        # windowed / tiled rendering
+        if 'window' in data:
+            out['window'] = [int(v) for v in _list( data['window'] )]
+            assert len(out['window']) == 4, "Error - window must be [xmin, ymin, xmax, ymax]"
+        if 'tile' in data:
+            out['tile'] = [int(v) for v in _list( data['tile'] )]
+            assert len(out['tile']) == 3, "Error - tile must be [z, x, y]"
+            out['tile_size'] = int(data.get('tile_size', 256))
+            assert out['tile_size'] > 0, "Error - tile_size must be positive"
+        if 'step' in data:
+            out['step'] = int(data['step'])
+            assert out['step'] > 0, "Error - step must be positive"
+    return out
+
+def _list( v ):
+    """
+    Parse a list that may have been passed as a string (e.g., in a url query).
+    """
+    if isinstance(v, str):
+        return json.loads(v) if v.strip().startswith('[') else v.split(',')
+    return v
+
+def getSourceTime( box, sensor ):
+    """
+    Get the modification time of the files storing a sensor's data in a box.
+
+    :param box: The Box instance containing the data.
+    :param sensor: The sensor name.
+    :return: The latest modification time (in ns) of the header and data files for this sensor, or None
+             if no such files exist.
+    """
+    times = [os.stat(f).st_mtime_ns for f in glob.glob(os.path.join(box.getDirectory(), glob.escape(sensor) + '.*'))]
+    if len(times) == 0:
+        return None
+    return max(times)
+
+def probe( data, x, y ):
+    """
+    Extract a pixel spectrum from a hyperspectral image.
+
+    :param data: The HyImage to probe. This can be memory mapped (see `CubeHandles`), in which case only the
+                 requested spectrum is read from disk.
+    :param x: The x coordinate of the pixel.
+    :param y: The y coordinate of the pixel.
+    :return: A dictionary containing wavelengths, units and reflectance values (R) that can be returned as json.
+    """
+    R = np.array(data.data[int(x), int(y), :], dtype=float)
+    if isinstance(data.data, np.memmap) or isinstance(data.data.base, np.memmap):
+        R[R == 0] = np.nan  # mask zeros as done when loading data normally
+    out = {}
+    out['wavelength'] = list(data.get_wavelengths().astype(float))
+    out['units'] = 'nm'
+    out['R'] = _finite(R)
+    return out
+
+STATS = ['mean', 'median', 'std', 'min', 'max']
+"""
+Statistics that can be computed by batch probes. Percentiles can also be computed using e.g., 'p5' or 'p95'.
+"""
+
+def getPixels( query, shape ):
+    """
+    Get the pixels selected by a batch probe query. This can contain a list of `points`, a polyline (`line`) that
+    will be sampled at every pixel it crosses, a rectangle (`rect = [xmin, ymin, xmax, ymax]`) or a `polygon`. If several
+    are defined, then the selected pixels are combined.
+
+    :param query: The parsed query (see `parseQuery(...)`).
+    :param shape: The (x, y) dimensions of the image being probed.
+    :return: Integer arrays containing the x and y coordinates of the selected pixels.
+    """
+    xs = []
+    ys = []
+    if 'points' in query:
+        pts = np.array(query['points'], dtype=float).reshape(-1, 2)
+        xs.append(pts[:, 0])
+        ys.append(pts[:, 1])
+    if 'line' in query:
+        pts = np.array(query['line'], dtype=float).reshape(-1, 2)
+        for p0, p1 in zip(pts[:-1], pts[1:]):
+            n = int(np.ceil(np.max(np.abs(p1 - p0)))) + 1
+            xs.append(np.linspace(p0[0], p1[0], n))
+            ys.append(np.linspace(p0[1], p1[1], n))
+        if len(pts) == 1:
+            xs.append(pts[:, 0])
+            ys.append(pts[:, 1])
+    if 'rect' in query:
+        x0, y0, x1, y1 = query['rect']
+        x0, x1 = max(min(x0, x1), 0), min(max(x0, x1), shape[0])
+        y0, y1 = max(min(y0, y1), 0), min(max(y0, y1), shape[1])
+        gx, gy = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1), indexing='ij')
+        xs.append(gx.ravel())
+        ys.append(gy.ravel())
+    if 'polygon' in query:
+        from matplotlib.path import Path
+        pts = np.array(query['polygon'], dtype=float).reshape(-1, 2)
+        x0, y0 = np.clip(np.floor(pts.min(axis=0)).astype(int), 0, None)
+        x1, y1 = np.minimum(np.ceil(pts.max(axis=0)).astype(int) + 1, shape[:2])
+        gx, gy = np.meshgrid(np.arange(x0, x1), np.arange(y0, y1), indexing='ij')
+        gx, gy = gx.ravel(), gy.ravel()
+        inside = Path(pts).contains_points(np.vstack([gx, gy]).T)
+        xs.append(gx[inside])
+        ys.append(gy[inside])
+    if len(xs) == 0:
+        return np.array([query['x']], dtype=int), np.array([query['y']], dtype=int)
+    xs = np.round(np.hstack(xs)).astype(int)
+    ys = np.round(np.hstack(ys)).astype(int)
+
+    # remove consecutive duplicates (e.g., where line segments join)
+    keep = np.ones(len(xs), dtype=bool)
+    keep[1:] = (np.diff(xs) != 0) | (np.diff(ys) != 0)
+    return xs[keep], ys[keep]
+
+def probeMany( data, xs, ys, stats=None ):
+    """
+    Extract several pixel spectra from a hyperspectral image, and optionally aggregate them into summary statistics.
+    These are extracted and computed in one vectorised pass over the image.
+
+    :param data: The HyImage to probe. This can be memory mapped (see `CubeHandles`), in which case only the
+                 requested spectra are read from disk.
+    :param xs: An array of pixel x coordinates.
+    :param ys: An array of pixel y coordinates.
+    :param stats: A list of statistics to compute (see `STATS`), or None (default) to return the individual spectra.
+    :return: A dictionary containing wavelengths, units and either the individual spectra (R) or the requested
+             statistics that can be returned as json.
+    """
+    xs = np.asarray(xs, dtype=int)
+    ys = np.asarray(ys, dtype=int)
+    if np.any(xs < 0) or np.any(ys < 0) or np.any(xs >= data.data.shape[0]) or np.any(ys >= data.data.shape[1]):
+        raise IndexError("Pixel coordinates are out of bounds.")
+    R = np.array(data.data[xs, ys, :], dtype=float)
+    if isinstance(data.data, np.memmap) or isinstance(data.data.base, np.memmap):
+        R[R == 0] = np.nan  # mask zeros as done when loading data normally
+
+    out = {}
+    out['wavelength'] = list(data.get_wavelengths().astype(float))
+    out['units'] = 'nm'
+    out['n'] = int(len(xs))
+    if stats is None:
+        out['x'] = xs.tolist()
+        out['y'] = ys.tolist()
+        out['R'] = _finite(R)
+    else:
+        import warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # all-nan slices
+            funcs = dict(mean=np.nanmean, median=np.nanmedian, std=np.nanstd, min=np.nanmin, max=np.nanmax)
+            pcts = [k for k in stats if k not in funcs]
+            if len(pcts) > 0:
+                P = np.nanpercentile(R, [float(k[1:]) for k in pcts], axis=0)  # all percentiles in one pass
+                P = np.reshape(P, (len(pcts), R.shape[1]))  # n.b. numpy drops the first axis for empty selections
+                for k, p in zip(pcts, P):
+                    out[k] = _finite(p)
+            for k in stats:
+                if k in funcs:
+                    out[k] = _finite(funcs[k](R, axis=0))
+    return out
+
+def _finite( values ):
+    """
+    Convert an array to (nested) lists, replacing non-finite values (e.g., masked pixels or statistics of empty
+    selections) with None, as NaN is not valid JSON.
+    """
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isfinite(values), values, None).tolist()
+
+class CubeHandles( object ):
+    """
+    A thread-safe least-recently-used cache of memory-mapped hyperspectral images. Memory mapping means that only the
+    parts of an image that are accessed (e.g., a single pixel spectrum) are read from disk, and caching the
+    handles avoids repeatedly parsing headers when probing the same box.
+    """
+    def __init__(self, max_handles : int = 64):
+        """
+        :param max_handles: The maximum number of images to keep mapped. Default is 64.
+        """
+        self.max_handles = max_handles
+        self._lock = threading.Lock()
+        self._handles = OrderedDict()
+
+    def get(self, box, sensor):
+        """
+        Get a memory-mapped image of a sensor's data in a box.
+
+        :param box: The Box instance containing the data.
+        :param sensor: The sensor name.
+        :return: A HyImage with memory-mapped data, or None if the data could not be mapped (e.g., because it is
+                 not stored in ENVI format).
+        """
+        path = os.path.join(box.getDirectory(), sensor + '.hdr')
+        mtime = getSourceTime(box, sensor)
+        if (mtime is None) or not os.path.exists(path):
+            return None
+        with self._lock:
+            if path in self._handles:
+                t, img = self._handles[path]
+                if t == mtime:
+                    self._handles.move_to_end(path)
+                    return img
+                del self._handles[path]  # file has changed
+        try:
+            img = hio.loadWithNumpy(path, memmap=True, mask_zero=False)
+        except Exception:
+            return None  # e.g., unsupported format or older version of hylite
+        with self._lock:
+            self._handles[path] = (mtime, img)
+            while len(self._handles) > self.max_handles:
+                self._handles.popitem(last=False)
+        return img
+
+    def clear(self):
+        """
+        Release all cached handles.
+        """
+        with self._lock:
+            self._handles.clear()
+
+def findSource( box, sensor ):
+    """
+    Find the file storing a sensor's data in a box (using the same rules as hylite when loading box attributes).
+
+    :param box: The Box instance containing the data.
+    :param sensor: The sensor name.
+    :return: The path to the header (or, if there is none, data) file, or None if no such file exists.
+    """
+    path = os.path.join(box.getDirectory(), sensor + '.hdr')
+    if os.path.exists(path):
+        return path
+    files = sorted(glob.glob(os.path.join(box.getDirectory(), glob.escape(sensor) + '.*')))
+    return files[0] if len(files) > 0 else None
+
+class CubeCache( object ):
+    """
+    A thread-safe least-recently-used cache of hyperspectral images loaded into memory, bounded by the total number of
+    bytes they use. Frequently requested (hot) images stay in memory while the least recently used ones are evicted.
+
+    Images are loaded directly from disk (rather than through the shared Shed instance), such that requests never
+    free data that another thread is still using. Cached images are shared between threads, so their data is
+    flagged as read-only. Evicting an image only drops the reference held by the cache, so threads that are still
+    using it are not affected.
+    """
+    def __init__(self, max_bytes : int = 1024 * 2**20):
+        """
+        :param max_bytes: Maximum number of bytes of image data to keep in memory. Default is 1 GB. Images larger
+                          than this are loaded for each request but never cached.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cubes = OrderedDict()
+        self._size = 0
+        self._loading = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cubes)
+
+    @property
+    def size(self):
+        """
+        The number of bytes of image data currently cached.
+        """
+        with self._lock:
+            return self._size
+
+    def get(self, box, sensor):
+        """
+        Get (and if needed load) a sensor's data in a box. If several threads request the same image at once it is
+        only loaded once.
+
+        :param box: The Box instance containing the data.
+        :param sensor: The sensor name.
+        :return: A HyImage with read-only data, or None if the data does not exist or could not be loaded.
+        """
+        path = findSource(box, sensor)
+        mtime = getSourceTime(box, sensor)
+        if (path is None) or (mtime is None):
+            return None
+        img = self._get(path, mtime)
+        if img is not None:
+            return img
+        with self._lock:
+            loading = self._loading.setdefault(path, threading.Lock())
+        with loading:  # n.b. other threads requesting this image wait for it to be loaded
+            img = self._get(path, mtime)
+            if img is not None:
+                return img
+            try:
+                with timer('load'):
+                    img = hio.load(path)
+            except Exception:
+                img = None  # e.g., corrupt or unsupported file
+            with self._lock:
+                self._loading.pop(path, None)
+                self.misses += 1
+            if img is None:
+                return None
+            img.data.flags.writeable = False
+            with self._lock:
+                if path in self._cubes:  # file has changed
+                    self._size -= self._cubes.pop(path)[1].data.nbytes
+                if img.data.nbytes <= self.max_bytes:
+                    self._cubes[path] = (mtime, img)
+                    self._size += img.data.nbytes
+                    while self._size > self.max_bytes:
+                        self._size -= self._cubes.popitem(last=False)[1][1].data.nbytes
+        return img
+
+    def _get(self, path, mtime):
+        """
+        Get an image from the cache, if it exists and is up to date.
+        """
+        with self._lock:
+            if (path in self._cubes) and (self._cubes[path][0] == mtime):
+                self._cubes.move_to_end(path)
+                self.hits += 1
+                return self._cubes[path][1]
+        return None
+
+    def clear(self):
+        """
+        Remove all images from this cache.
+        """
+        with self._lock:
+            self._cubes.clear()
+            self._size = 0
+
+def getQueryKey( query, mtime ):
+    """
+    Get a unique key identifying a query and the state of its source data. This is used for caching
+    and as an ETag.
+
+    :param query: The parsed query (see `parseQuery(...)`).
+    :param mtime: The modification time of the source data (see `getSourceTime(...)`).
+    :return: A hex string.
+    """
+    items = sorted( (k, repr(v)) for k, v in query.items() )
+    return hashlib.sha1( repr( (items, mtime) ).encode('utf-8') ).hexdigest()
+
+def render( data, op, vmin, vmax, tscale=False ):
+    """
+    Evaluate an operation on a hyperspectral dataset and convert the result to a PNG image.
+
+    :param data: The HyImage to evaluate.
+    :param op: The operation string, following the syntax of `hylite.HyData.eval( ... )`.
+    :param vmin: The lower clip value. If both vmin and vmax are integers these are treated as percentiles, otherwise
+                 they are treated as absolute values (either one value or a list with one value per output band).
+    :param vmax: The upper clip value.
+    :param tscale: True if percentile clips should be applied to each band separately.
+    :return: Bytes containing the encoded PNG image.
+    """
+    with timer('eval'):
+        result = data.eval(op)  # evaluate result
+
+    # apply normalisation
+    with timer('normalise'):
+        if isinstance(vmin, int) and isinstance(vmax, int):
+            result.percent_clip(vmin, vmax, per_band=tscale)
+        else:
+            vmin = np.array(vmin, dtype=float)  # n.b. can be arrays containing per-band values
+            vmax = np.array(vmax, dtype=float)
+            result.data = (result.data - vmin) / (vmax - vmin)
+        result.data = np.clip(result.data * 255, 0, 255).astype(np.uint8)
+        if result.band_count() == 1:
+            result.data = np.dstack([result.data] * 3)
+        if result.band_count() > 3:
+            result.data = result.data[..., :3]
+
+    # encode as PNG image
+    with timer('encode'):
+        img = Image.fromarray(result.data)
+        file_object = BytesIO()
+        img.save(file_object, 'PNG')
+        return file_object.getvalue()
+
+WINDOW = ['window', 'tile', 'tile_size', 'step']
+"""
+Query parameters that select a region (and resolution) of the image to render.
+"""
+
+def getWindow( query, shape ):
+    """
+    Get the region and resolution of an image selected by a windowed render query. This can either contain a pixel
+    `window = [xmin, ymin, xmax, ymax]` and an optional downsampling `step`, or XYZ-style tile indices `tile = [z, x, y]`
+    and a `tile_size` (default 256). For tiles, z = 0 corresponds to the whole image in one tile, and each subsequent
+    zoom level doubles the resolution until the full resolution is reached. Tiles on the image edges may be smaller than
+    `tile_size`.
+
+    :param query: The parsed query (see `parseQuery(...)`).
+    :param shape: The (x, y) dimensions of the image being rendered.
+    :return: A tuple containing (xmin, xmax, ymin, ymax, step).
+    """
+    if 'tile' in query:
+        z, tx, ty = query['tile']
+        ts = query['tile_size']
+        zmax = max(int(np.ceil(np.log2(max(shape[0], shape[1]) / ts))), 0)
+        if (z < 0) or (z > zmax):
+            raise IndexError("Zoom level must be between 0 and %d." % zmax)
+        step = 2 ** (zmax - z)
+        x0, y0 = tx * ts * step, ty * ts * step
+        if (tx < 0) or (ty < 0) or (x0 >= shape[0]) or (y0 >= shape[1]):
+            raise IndexError("Tile is outside of the image.")
+        return x0, min(x0 + ts * step, shape[0]), y0, min(y0 + ts * step, shape[1]), step
+    x0, y0, x1, y1 = query.get('window', [0, 0, shape[0], shape[1]])
+    x0, x1 = max(min(x0, x1), 0), min(max(x0, x1), shape[0])
+    y0, y1 = max(min(y0, y1), 0), min(max(y0, y1), shape[1])
+    if (x0 >= x1) or (y0 >= y1):
+        raise IndexError("Window is outside of the image.")
+    return x0, x1, y0, y1, query.get('step', 1)
+
+def readWindow( data, xmin, xmax, ymin, ymax, step=1 ):
+    """
+    Read a region of a hyperspectral image. If the image is memory mapped (see `CubeHandles`), only this region is
+    read from disk.
+
+    :param data: The HyImage to read from.
+    :param xmin: The first x coordinate to read.
+    :param xmax: The last x coordinate (exclusive) to read.
+    :param ymin: The first y coordinate to read.
+    :param ymax: The last y coordinate (exclusive) to read.
+    :param step: Downsampling step. Default is 1 (full resolution).
+    :return: A new HyImage containing the data in this region.
+    """
+    with timer('read'):
+        arr = np.array(data.data[xmin:xmax:step, ymin:ymax:step, :], dtype=np.float32)
+    if isinstance(data.data, np.memmap) or isinstance(data.data.base, np.memmap):
+        arr[arr == 0] = np.nan  # mask zeros as done when loading data normally
+    return hylite.HyImage(arr, header=data.header.copy())
+
+def getClipLimits( data, op, vmin, vmax, tscale=False, size : int = 512 ):
+    """
+    Get the absolute values corresponding to percentile clips of an operation evaluated on a whole image. This is
+    estimated from a downsampled overview of the image, such that windows or tiles of the image can be rendered
+    with consistent normalisation.
+
+    :param data: The HyImage to evaluate.
+    :param op: The operation string, following the syntax of `hylite.HyData.eval( ... )`.
+    :param vmin: The lower percentile.
+    :param vmax: The upper percentile.
+    :param tscale: True if percentiles should be computed for each band separately.
+    :param size: The approximate size (in pixels) of the long axis of the overview image. Default is 512.
+    :return: Lists containing the lower and upper values (one per band if tscale is True).
+    """
+    step = max(int(np.ceil(max(data.data.shape[0], data.data.shape[1]) / size)), 1)
+    result = readWindow(data, 0, data.data.shape[0], 0, data.data.shape[1], step)
+    with timer('clip'):
+        lo, hi = result.eval(op).percent_clip(vmin, vmax, per_band=tscale)
+    return np.atleast_1d(lo).tolist(), np.atleast_1d(hi).tolist()
+
+class RenderCache( object ):
+    """
+    A thread-safe least-recently-used cache for rendered images, bounded by the total number of bytes stored in
+    memory. Entries evicted from memory can optionally be spilled to a (also bounded) cache directory on disk.
+    """
+    def __init__(self, max_bytes : int = 64 * 2**20, directory : str = None, max_disk_bytes : int = 1024 * 2**20):
+        """
+        :param max_bytes: Maximum number of bytes to keep in memory. Default is 64 MB.
+        :param directory: A directory to spill evicted entries to, or None (default) to disable this.
+        :param max_disk_bytes: Maximum number of bytes to keep in the cache directory. Default is 1 GB.
+        """
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._mem = OrderedDict()
+        self._mem_size = 0
+        self._disk = OrderedDict()
+        self._disk_size = 0
+
+        # index entries spilled to disk previously
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.bin')]
+            for f in sorted(files, key=os.path.getmtime):
+                n = os.path.getsize(f)
+                self._disk[os.path.splitext(os.path.basename(f))[0]] = n
+                self._disk_size += n
+            self._trim()
+
+    def __contains__(self, key):
+        with self._lock:
+            return (key in self._mem) or (key in self._disk)
+
+    def get(self, key):
+        """
+        Get a cached entry.
+
+        :param key: The (string) key of the entry.
+        :return: The cached bytes, or None if the entry is not in the cache.
+        """
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return self._mem[key]
+            if key in self._disk:
+                try:
+                    with open(self._path(key), 'rb') as f:
+                        value = f.read()
+                except OSError:
+                    self._disk_size -= self._disk.pop(key)
+                    return None
+                self._disk.move_to_end(key)
+                self._put(key, value)
+                return value
+        return None
+
+    def put(self, key, value):
+        """
+        Add an entry to the cache.
+
+        :param key: The (string) key of the entry.
+        :param value: The bytes to store.
+        """
+        with self._lock:
+            self._put(key, value)
+
+    def clear(self):
+        """
+        Remove all entries from this cache (including any spilled to disk).
+        """
+        with self._lock:
+            for key in self._disk:
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._mem.clear()
+            self._disk.clear()
+            self._mem_size = 0
+            self._disk_size = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.bin')
+
+    def _put(self, key, value):
+        if key in self._mem:
+            self._mem_size -= len(self._mem.pop(key))
+        if len(value) > self.max_bytes:
+            return  # too big to cache
+        self._mem[key] = value
+        self._mem_size += len(value)
+        while self._mem_size > self.max_bytes:
+            k, v = self._mem.popitem(last=False)
+            self._mem_size -= len(v)
+            if (self.directory is not None) and (k not in self._disk):
+                try:
+                    with open(self._path(k), 'wb') as f:
+                        f.write(v)
+                    self._disk[k] = len(v)
+                    self._disk_size += len(v)
+                except OSError:
+                    pass  # could not spill; entry is simply dropped
+        self._trim()
+
+    def _trim(self):
+        while self._disk_size > self.max_disk_bytes:
+            k, n = self._disk.popitem(last=False)
+            self._disk_size -= n
+            try:
+                os.remove(self._path(k))
+            except OSError:
+                pass